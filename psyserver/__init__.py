@@ -1,5 +1,7 @@
 import argparse
 
+from psyserver.archive import compact_study
+from psyserver.backup import backup
 from psyserver.db import create_studies_table
 from psyserver.init import init_dir
 from psyserver.run import run_server
@@ -39,12 +41,101 @@ def main():
     )
     parser_init_db.set_defaults(func=create_studies_table)
 
+    # compact command
+    parser_compact = subparsers.add_parser(
+        "compact", help="pack old submissions of a study into per-day archives"
+    )
+    parser_compact.set_defaults(func=compact_study)
+    parser_compact.add_argument("study", help="name of the study to compact.")
+    parser_compact.add_argument(
+        "--older-than",
+        type=float,
+        default=30,
+        help="only compact submissions older than this many days (default: 30).",
+    )
+    parser_compact.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of days compacted in parallel.",
+    )
+
+    # backup command
+    parser_backup = subparsers.add_parser(
+        "backup", help="incrementally back up study data and counter.db"
+    )
+    parser_backup.set_defaults(func=backup)
+    parser_backup.add_argument("dest", help="directory to store the snapshots in.")
+    parser_backup.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of files hashed in parallel.",
+    )
+
+    # bench command
+    parser_bench = subparsers.add_parser(
+        "bench", help="benchmark the server with simulated participants"
+    )
+    parser_bench.set_defaults(func="bench")
+    parser_bench.add_argument(
+        "--participants",
+        type=int,
+        default=50,
+        help="number of simultaneous participants (default: 50).",
+    )
+    parser_bench.add_argument(
+        "--rounds",
+        type=int,
+        default=1,
+        help="times each participant goes through all routes (default: 1).",
+    )
+    parser_bench.add_argument(
+        "--trial-kb",
+        type=float,
+        default=100,
+        help="size of the data posted to save in kB (default: 100).",
+    )
+    parser_bench.add_argument(
+        "--audio-kb",
+        type=float,
+        default=200,
+        help="size of the audio uploaded to save_audio in kB (default: 200).",
+    )
+    parser_bench.add_argument(
+        "--url",
+        default=None,
+        help="benchmark a running server instead of an in-process temporary one.",
+    )
+    parser_bench.add_argument(
+        "--output", default=None, help="file to write the json report to."
+    )
+
     # parse arguments
     args = parser.parse_args()
 
     # run command
     if args.func == run_server:
         return args.func(psyserver_dir=args.psyserver_dir)
+    if args.func == compact_study:
+        return args.func(
+            args.study, older_than_days=args.older_than, workers=args.workers
+        )
+    if args.func == backup:
+        return args.func(args.dest, workers=args.workers)
+    if args.func == "bench":
+        # imported only here, as it loads the whole app
+        from psyserver.bench import bench
+
+        return bench(
+            participants=args.participants,
+            rounds=args.rounds,
+            trial_kb=args.trial_kb,
+            audio_kb=args.audio_kb,
+            url=args.url,
+            output=args.output,
+            version=__version__,
+        )
     return args.func()
 
 
@@ -0,0 +1,46 @@
+from fastapi import FastAPI
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
+
+from psyserver.events import MONITOR, MONITOR_HTML
+from psyserver.media import get_media_jobs
+from psyserver.metrics import REGISTRY
+from psyserver.settings import get_settings_toml
+from psyserver.usage import USAGE
+
+
+def create_admin_app() -> FastAPI:
+    """App with monitoring routes, to be served on an internal interface only."""
+    app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        """Metrics in the Prometheus text format."""
+        return PlainTextResponse(
+            REGISTRY.render(), media_type="text/plain; version=0.0.4"
+        )
+
+    @app.get("/events")
+    async def events():
+        """Server-sent events with per-study submission counts."""
+        return StreamingResponse(
+            MONITOR.stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.get("/monitor", response_class=HTMLResponse)
+    async def monitor():
+        """Page showing submissions per study as they come in."""
+        return HTMLResponse(MONITOR_HTML)
+
+    @app.get("/media/{study}")
+    def media_jobs(study: str):
+        """Post-processing jobs of the audio uploads of `study`."""
+        return get_media_jobs(get_settings_toml().media_jobs_db, study)
+
+    @app.get("/usage")
+    def usage():
+        """Bytes and files of saved data per study and session."""
+        return USAGE.report()
+
+    return app
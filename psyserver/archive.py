@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from psyserver.settings import get_settings_toml
+
+ARCHIVE_DIR_NAME = "_archive"
+ARCHIVE_INDEX_NAME = "index.json"
+
+
+def sha256_file(path: Path) -> str:
+    """Hex sha256 digest of the file at `path`, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f_in:
+        for chunk in iter(lambda: f_in.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _sha256_member(archive: zipfile.ZipFile, name: str) -> str:
+    digest = hashlib.sha256()
+    with archive.open(name) as f_in:
+        for chunk in iter(lambda: f_in.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def archive_index_path(directory: Path) -> Path:
+    return directory / ARCHIVE_DIR_NAME / ARCHIVE_INDEX_NAME
+
+
+def load_archive_index(directory: Path) -> Dict[str, Dict]:
+    """Load the index mapping compacted filenames to their archive."""
+    index_path = archive_index_path(directory)
+    if not index_path.exists():
+        return {}
+    with open(index_path, "r") as f_index:
+        return json.load(f_index)
+
+
+def _write_archive_index(directory: Path, index: Dict[str, Dict]) -> None:
+    index_path = archive_index_path(directory)
+    tmp_path = index_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f_index:
+        json.dump(index, f_index)
+    os.replace(tmp_path, index_path)
+
+
+def find_compactable(
+    study_dir: Path, cutoff: float
+) -> Dict[Tuple[Path, str], List[Path]]:
+    """Group json submissions last modified before `cutoff` by directory and day."""
+    groups: Dict[Tuple[Path, str], List[Path]] = defaultdict(list)
+    for dirpath, dirnames, filenames in os.walk(study_dir):
+        # never descend into existing archives
+        dirnames[:] = [d for d in dirnames if d != ARCHIVE_DIR_NAME]
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+            path = Path(dirpath) / filename
+            mtime = path.stat().st_mtime
+            if mtime >= cutoff:
+                continue
+            day = date.fromtimestamp(mtime).isoformat()
+            groups[(Path(dirpath), day)].append(path)
+    return groups
+
+
+def _compact_day(
+    directory: Path, day: str, paths: List[Path]
+) -> Tuple[Dict[str, Dict], List[Path]]:
+    """Pack the files of a single day into `<directory>/_archive/<day>.zip`.
+
+    Returns
+    -------
+    entries : dict
+        Index entries for every file that is verified to be in the archive.
+    conflicts : list
+        Files whose name already exists in the archive with different content.
+    """
+    archive_name = f"{day}.zip"
+    archive_path = directory / ARCHIVE_DIR_NAME / archive_name
+    archive_path.parent.mkdir(exist_ok=True)
+
+    checksums = {path.name: sha256_file(path) for path in paths}
+    conflicts: List[Path] = []
+    with zipfile.ZipFile(archive_path, "a", compression=zipfile.ZIP_DEFLATED) as zf:
+        existing = set(zf.namelist())
+        for path in paths:
+            if path.name not in existing:
+                zf.write(path, arcname=path.name)
+
+    # verify checksums from the written archive before anything is deleted
+    entries: Dict[str, Dict] = {}
+    with zipfile.ZipFile(archive_path, "r") as zf:
+        for path in paths:
+            if _sha256_member(zf, path.name) != checksums[path.name]:
+                conflicts.append(path)
+                continue
+            entries[path.name] = {
+                "archive": archive_name,
+                "sha256": checksums[path.name],
+                "size": zf.getinfo(path.name).file_size,
+            }
+    return entries, conflicts
+
+
+def compact_study(
+    study: str, older_than_days: float = 30, workers: Optional[int] = None
+) -> int:
+    """Pack old json submissions of a study into per-day zip archives.
+
+    Submissions are grouped per directory by the day they were last modified.
+    Originals are only deleted once their checksum was verified in the archive
+    and the directory index was updated.
+
+    Parameters
+    ----------
+    study : str
+        Name of the study directory in `data_dir`.
+    older_than_days : float, default = 30
+        Only submissions last modified longer ago than this are compacted.
+    workers : int | None, default = `None`
+        Number of days compacted in parallel. `None` lets python decide.
+    """
+    settings = get_settings_toml()
+    base_path = Path(settings.data_dir)
+    study_dir = base_path / study
+    if not study_dir.resolve().is_relative_to(base_path.resolve()):
+        print(f"Invalid study '{study}'.")
+        return 1
+    if not study_dir.is_dir():
+        print(f"No data for study '{study}' in {base_path}.")
+        return 1
+
+    cutoff = time.time() - older_than_days * 86400
+    groups = find_compactable(study_dir, cutoff)
+    if not groups:
+        print("Nothing to compact.")
+        return 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            key: executor.submit(_compact_day, key[0], key[1], paths)
+            for key, paths in groups.items()
+        }
+        results = {key: future.result() for key, future in futures.items()}
+
+    # merge the index once per directory, then delete the verified originals
+    per_directory: Dict[Path, Dict[str, Dict]] = defaultdict(dict)
+    n_conflicts = 0
+    for (directory, _), (entries, conflicts) in results.items():
+        per_directory[directory].update(entries)
+        for path in conflicts:
+            print(f"WARNING: {path} differs from its archived copy, kept.")
+        n_conflicts += len(conflicts)
+
+    n_compacted = 0
+    for directory, entries in per_directory.items():
+        index = load_archive_index(directory)
+        index.update(entries)
+        _write_archive_index(directory, index)
+        for name in entries:
+            (directory / name).unlink()
+        n_compacted += len(entries)
+
+    print(f"Compacted {n_compacted} submissions into {len(groups)} day archives.")
+    return 1 if n_conflicts else 0
+
+
+def read_submission(path: Path | str) -> bytes:
+    """Read a submission, transparently falling back to its day archive."""
+    path = Path(path)
+    if path.exists():
+        with open(path, "rb") as f_in:
+            return f_in.read()
+    entry = load_archive_index(path.parent).get(path.name)
+    if entry is None:
+        raise FileNotFoundError(path)
+    archive_path = path.parent / ARCHIVE_DIR_NAME / entry["archive"]
+    with zipfile.ZipFile(archive_path, "r") as zf:
+        return zf.read(path.name)
+
+
+def iter_submissions(study_dir: Path | str) -> Iterator[Tuple[Path, bytes]]:
+    """Yield `(path, content)` of all json submissions, loose or archived.
+
+    Archived submissions are reported under their original path.
+    """
+    study_dir = Path(study_dir)
+    for dirpath, dirnames, filenames in os.walk(study_dir):
+        dirnames[:] = [d for d in dirnames if d != ARCHIVE_DIR_NAME]
+        directory = Path(dirpath)
+        for filename in sorted(filenames):
+            if filename.endswith(".json"):
+                with open(directory / filename, "rb") as f_in:
+                    yield directory / filename, f_in.read()
+
+        by_archive: Dict[str, List[str]] = defaultdict(list)
+        for name, entry in load_archive_index(directory).items():
+            by_archive[entry["archive"]].append(name)
+        for archive_name, names in sorted(by_archive.items()):
+            archive_path = directory / ARCHIVE_DIR_NAME / archive_name
+            with zipfile.ZipFile(archive_path, "r") as zf:
+                for name in sorted(names):
+                    yield directory / name, zf.read(name)
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from psyserver.archive import sha256_file
+from psyserver.db import backup_db
+from psyserver.settings import default_db_path, get_settings_toml
+
+MANIFEST_NAME = "manifest.json"
+LATEST_NAME = "latest"
+
+
+def _relative_root(root: Path) -> Path:
+    """Location of a backed up directory inside a snapshot."""
+    if root.is_absolute():
+        try:
+            return root.relative_to(Path.cwd())
+        except ValueError:
+            return Path(root.name)
+    return root
+
+
+def load_latest_snapshot(dest: Path) -> Tuple[Optional[Path], Dict[str, Dict]]:
+    """Return the latest snapshot in `dest` and its manifest."""
+    latest_path = dest / LATEST_NAME
+    if not latest_path.exists():
+        return None, {}
+    snapshot = dest / latest_path.read_text().strip()
+    manifest_path = snapshot / MANIFEST_NAME
+    if not manifest_path.exists():
+        return None, {}
+    with open(manifest_path, "r") as f_manifest:
+        return snapshot, json.load(f_manifest)
+
+
+def _scan(roots: List[Path]) -> List[Tuple[Path, str, os.stat_result]]:
+    files = []
+    for root in roots:
+        rel_root = _relative_root(root)
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = Path(dirpath) / filename
+                rel = rel_root / path.relative_to(root)
+                files.append((path, rel.as_posix(), path.stat()))
+    return files
+
+
+def _link_or_copy(source: Path, target: Path) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        # e.g. snapshot on another filesystem
+        shutil.copy2(source, target)
+
+
+def backup(dest: Path | str, workers: Optional[int] = None) -> int:
+    """Create an incremental snapshot of the study directories and counter.db.
+
+    Each snapshot is a directory `<dest>/<timestamp>` with a manifest of the
+    size, mtime and sha256 of every file. Files unchanged since the latest
+    snapshot are hardlinked into the new one instead of copied; only files
+    with a changed size or mtime are hashed.
+
+    Parameters
+    ----------
+    dest : Path | str
+        Directory containing the snapshots.
+    workers : int | None, default = `None`
+        Number of files hashed in parallel. `None` lets python decide.
+    """
+    settings = get_settings_toml()
+    dest = Path(dest)
+    dest.mkdir(parents=True, exist_ok=True)
+
+    roots = [Path(settings.studies_dir), Path(settings.data_dir)]
+    previous_snapshot, previous_manifest = load_latest_snapshot(dest)
+
+    snapshot_name = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    snapshot = dest / snapshot_name
+    snapshot.mkdir()
+
+    files = _scan([root for root in roots if root.is_dir()])
+    manifest: Dict[str, Dict] = {}
+    to_hash: List[Tuple[Path, str]] = []
+    for path, rel, stat in files:
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        previous = previous_manifest.get(rel)
+        if (
+            previous is not None
+            and previous["size"] == entry["size"]
+            and previous["mtime_ns"] == entry["mtime_ns"]
+        ):
+            entry["sha256"] = previous["sha256"]
+        else:
+            to_hash.append((path, rel))
+        manifest[rel] = entry
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = executor.map(sha256_file, [path for path, _ in to_hash])
+        for (_, rel), sha256 in zip(to_hash, hashes):
+            manifest[rel]["sha256"] = sha256
+
+    n_copied = 0
+    for path, rel, _ in files:
+        target = snapshot / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        previous = previous_manifest.get(rel)
+        if (
+            previous_snapshot is not None
+            and previous is not None
+            and previous["sha256"] == manifest[rel]["sha256"]
+            and (previous_snapshot / rel).exists()
+        ):
+            _link_or_copy(previous_snapshot / rel, target)
+        else:
+            shutil.copy2(path, target)
+            n_copied += 1
+
+    if default_db_path().exists():
+        backup_db(snapshot / default_db_path().name)
+
+    with open(snapshot / MANIFEST_NAME, "w") as f_manifest:
+        json.dump(manifest, f_manifest)
+    tmp_latest = dest / f"{LATEST_NAME}.tmp"
+    tmp_latest.write_text(snapshot_name)
+    os.replace(tmp_latest, dest / LATEST_NAME)
+
+    print(
+        f"Backed up {len(files)} files to {snapshot}"
+        f" ({n_copied} copied, {len(files) - n_copied} linked)."
+    )
+    return 0
@@ -0,0 +1,224 @@
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from psyserver.init import init_dir
+from psyserver.main import create_app
+from psyserver.settings import reset_settings
+
+BENCH_STUDY = "exp_cute"
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return float("nan")
+    rank = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(
+    samples: Dict[str, List[Tuple[float, bool]]], duration: float
+) -> Dict[str, Dict]:
+    """Throughput and latency percentiles (in ms) per route."""
+    routes = {}
+    for route, route_samples in sorted(samples.items()):
+        latencies = sorted(latency * 1000 for latency, _ in route_samples)
+        routes[route] = {
+            "requests": len(route_samples),
+            "errors": sum(1 for _, ok in route_samples if not ok),
+            "throughput_rps": len(route_samples) / duration,
+            "mean_ms": sum(latencies) / len(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": latencies[-1],
+        }
+    return routes
+
+
+def _trial_data(participant: int, trial_kb: float) -> Dict:
+    trial = {"trial": 0, "condition": "1", "response": 2, "rt": 523.4}
+    n_trials = max(1, int(trial_kb * 1024 / len(json.dumps(trial))))
+    return {
+        "participantID": f"bench_{participant}",
+        "trialdata": [{**trial, "trial": idx} for idx in range(n_trials)],
+    }
+
+
+async def _participant(
+    client: httpx.AsyncClient,
+    participant: int,
+    rounds: int,
+    trial_kb: float,
+    audio: bytes,
+    samples: Dict[str, List[Tuple[float, bool]]],
+) -> None:
+    """Simulate one participant: load study, get count, save data and audio."""
+
+    async def timed(route: str, method: str, url: str, **kwargs) -> None:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        samples[route].append((time.perf_counter() - start, ok))
+
+    data = _trial_data(participant, trial_kb)
+    for round_idx in range(rounds):
+        await timed("static", "GET", f"/{BENCH_STUDY}/")
+        await timed("get_count", "GET", f"/{BENCH_STUDY}/get_count")
+        await timed("save", "POST", f"/{BENCH_STUDY}/save", json=data)
+        await timed(
+            "save_audio",
+            "POST",
+            f"/{BENCH_STUDY}/save_audio",
+            files={
+                "audio_data": (
+                    f"bench_{participant}-{round_idx}.wav",
+                    audio,
+                    "audio/wav",
+                )
+            },
+        )
+
+
+async def _run(
+    client: httpx.AsyncClient,
+    participants: int,
+    rounds: int,
+    trial_kb: float,
+    audio_kb: float,
+) -> Tuple[Dict[str, List[Tuple[float, bool]]], float]:
+    samples: Dict[str, List[Tuple[float, bool]]] = defaultdict(list)
+    audio = os.urandom(int(audio_kb * 1024))
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            _participant(client, idx, rounds, trial_kb, audio, samples)
+            for idx in range(participants)
+        )
+    )
+    return samples, time.perf_counter() - start
+
+
+def run_bench(
+    participants: int = 50,
+    rounds: int = 1,
+    trial_kb: float = 100,
+    audio_kb: float = 200,
+    url: Optional[str] = None,
+    output: Optional[Path | str] = None,
+    version: Optional[str] = None,
+) -> Dict:
+    """Simulate concurrent participants and report per-route latencies.
+
+    Without `url`, the app is run in-process against a fresh example psyserver
+    directory in a temporary directory, the same way the tests do. Otherwise
+    the server running at `url` is benchmarked, which has to serve the example
+    study `exp_cute`.
+
+    Parameters
+    ----------
+    participants : int, default = 50
+        Number of simultaneous participants.
+    rounds : int, default = 1
+        Number of times each participant goes through all routes.
+    trial_kb : float, default = 100
+        Approximate size of the json data posted to `save`.
+    audio_kb : float, default = 200
+        Size of the file uploaded to `save_audio`.
+    url : str | None, default = `None`
+        Base url of a running server to benchmark.
+    output : Path | str | None, default = `None`
+        File to write the json report to.
+    version : str | None, default = `None`
+        Version of psyserver, recorded in the report.
+
+    Returns
+    -------
+    report : dict
+        Configuration, total duration and per-route statistics.
+    """
+    config = {
+        "participants": participants,
+        "rounds": rounds,
+        "trial_kb": trial_kb,
+        "audio_kb": audio_kb,
+        "target": url or "in-process",
+    }
+    timeout = httpx.Timeout(60)
+
+    if url is not None:
+
+        async def bench_remote():
+            limits = httpx.Limits(max_connections=participants)
+            async with httpx.AsyncClient(
+                base_url=url, timeout=timeout, limits=limits
+            ) as client:
+                return await _run(client, participants, rounds, trial_kb, audio_kb)
+
+        samples, duration = asyncio.run(bench_remote())
+    else:
+        cwd = Path.cwd()
+        with tempfile.TemporaryDirectory() as bench_dir:
+            os.chdir(bench_dir)
+            try:
+                # keep stdout clean for the report
+                with contextlib.redirect_stdout(sys.stderr):
+                    init_dir(no_filebrowser=True)
+                reset_settings()
+                app = create_app(start_filebrowser=False)
+
+                async def bench_local():
+                    transport = httpx.ASGITransport(app=app)
+                    async with httpx.AsyncClient(
+                        transport=transport, base_url="http://bench", timeout=timeout
+                    ) as client:
+                        return await _run(
+                            client, participants, rounds, trial_kb, audio_kb
+                        )
+
+                samples, duration = asyncio.run(bench_local())
+            finally:
+                os.chdir(cwd)
+                reset_settings()
+
+    report = {
+        "version": version,
+        "config": config,
+        "duration_s": duration,
+        "routes": summarize(samples, duration),
+    }
+    if output is not None:
+        with open(output, "w") as f_out:
+            json.dump(report, f_out, indent=2)
+    return report
+
+
+def bench(
+    participants: int = 50,
+    rounds: int = 1,
+    trial_kb: float = 100,
+    audio_kb: float = 200,
+    url: Optional[str] = None,
+    output: Optional[str] = None,
+    version: Optional[str] = None,
+) -> int:
+    """Command line entry of `run_bench`, prints the report as json."""
+    report = run_bench(participants, rounds, trial_kb, audio_kb, url, output, version)
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    errors = sum(route["errors"] for route in report["routes"].values())
+    return 1 if errors else 0
@@ -1,8 +1,11 @@
 import sqlite3
+import time
 from pathlib import Path
 from typing import Optional, Tuple
 
+from psyserver.metrics import COUNTER_DB_DURATION
 from psyserver.settings import default_db_path
+from psyserver.tracing import trace_add
 
 
 class SQLite:
@@ -29,11 +32,37 @@ def create_studies_table():
     with SQLite(default_db_path()) as conn:
         cur = conn.cursor()
         cur.execute(command)
+        _create_idempotency_table_cur(cur)
         conn.commit()
 
 
+def create_idempotency_table() -> None:
+    """Create the idempotency table, for databases predating it."""
+    with SQLite(default_db_path()) as conn:
+        cur = conn.cursor()
+        _create_idempotency_table_cur(cur)
+        conn.commit()
+
+
+def _create_idempotency_table_cur(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS idempotency (
+            study TEXT,
+            key TEXT,
+            response TEXT,
+            created REAL,
+            PRIMARY KEY (study, key)
+        );"""
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idempotency_created ON idempotency (created);"
+    )
+
+
 def get_increment_study_count_db(study: str) -> Tuple[Optional[int], Optional[str]]:
     """Fetch and increment the study participant count."""
+    start = time.perf_counter()
     count = None
     error = None
     with SQLite(default_db_path()) as conn:
@@ -57,6 +86,9 @@ def get_increment_study_count_db(study: str) -> Tuple[Optional[int], Optional[st
             cur.execute("UPDATE studies SET count=? WHERE study=?", (count + 1, study))
             conn.commit()
 
+    duration = time.perf_counter() - start
+    COUNTER_DB_DURATION.labels("get_increment").observe(duration)
+    trace_add("counter_db", duration)
     return count, error
 
 
@@ -77,6 +109,7 @@ def set_study_count_db(study: str, count: int) -> Optional[str]:
     error : str | None
         A string describing the error, or None for success.
     """
+    start = time.perf_counter()
     error = None
     with SQLite(default_db_path()) as conn:
         cur = conn.cursor()
@@ -86,4 +119,56 @@ def set_study_count_db(study: str, count: int) -> Optional[str]:
             error = "table missing, run 'psyserver init_db'"
         else:
             conn.commit()
+    duration = time.perf_counter() - start
+    COUNTER_DB_DURATION.labels("set").observe(duration)
+    trace_add("counter_db", duration)
     return error
+
+
+def get_idempotent_response_db(
+    study: str, key: str, min_created: float
+) -> Optional[Tuple[str, float]]:
+    """Fetch the stored response and its creation time, if not expired."""
+    with SQLite(default_db_path()) as conn:
+        cur = conn.cursor()
+        try:
+            res = cur.execute(
+                "SELECT response, created FROM idempotency"
+                " WHERE study=? AND key=? AND created>=?",
+                (study, key, min_created),
+            )
+        except sqlite3.OperationalError:
+            # table predates idempotency support
+            return None
+        item = res.fetchone()
+    return item
+
+
+def set_idempotent_response_db(
+    study: str, key: str, response: str, created: float, min_created: float
+) -> None:
+    """Store the response for an idempotency key and drop expired ones."""
+    with SQLite(default_db_path()) as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM idempotency WHERE created<?", (min_created,))
+        cur.execute(
+            "INSERT OR REPLACE INTO idempotency (study, key, response, created)"
+            " VALUES (?, ?, ?, ?)",
+            (study, key, response, created),
+        )
+        conn.commit()
+
+
+def backup_db(dest: Path, pages: int = 64) -> None:
+    """Copy the counter database to `dest` using the SQLite online backup API.
+
+    The copy is made in steps of `pages` pages, so concurrent counter
+    requests only wait for a single step instead of the whole copy.
+    """
+    source = sqlite3.connect(f"file:{default_db_path()}?mode=ro", uri=True)
+    target = sqlite3.connect(dest)
+    try:
+        source.backup(target, pages=pages)
+    finally:
+        target.close()
+        source.close()
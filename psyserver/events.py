@@ -0,0 +1,100 @@
+import asyncio
+import json
+from typing import AsyncIterator, Dict, Tuple
+
+EVENT_KINDS = ("save", "audio", "count", "error")
+PUSH_INTERVAL = 0.5
+KEEPALIVE_INTERVAL = 15.0
+
+MONITOR_HTML = """\
+<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8" />
+    <title>PsyServer monitor</title>
+    <style>
+      body { font-family: sans-serif; }
+      td, th { padding: 0.2em 1em; text-align: right; }
+      th:first-child, td:first-child { text-align: left; }
+    </style>
+  </head>
+  <body>
+    <h1>Submissions since server start</h1>
+    <table>
+      <thead>
+        <tr><th>study</th><th>save</th><th>audio</th><th>count</th><th>error</th></tr>
+      </thead>
+      <tbody id="studies"></tbody>
+    </table>
+    <script>
+      const kinds = ["save", "audio", "count", "error"];
+      const source = new EventSource("events");
+      source.onmessage = (event) => {
+        const studies = JSON.parse(event.data);
+        const rows = Object.keys(studies).sort().map((study) => {
+          const cells = kinds.map((kind) => `<td>${studies[study][kind]}</td>`);
+          const name = document.createElement("td");
+          name.textContent = study;
+          return `<tr>${name.outerHTML}${cells.join("")}</tr>`;
+        });
+        document.getElementById("studies").innerHTML = rows.join("");
+      };
+    </script>
+  </body>
+</html>
+"""
+
+
+class SubmissionMonitor:
+    """Per-study counts of submissions, pushed to any number of subscribers.
+
+    Routes call `emit`, which only increments a counter. Subscribers are woken
+    every `PUSH_INTERVAL` seconds and receive the counts if anything changed,
+    so bursts of events are coalesced into one message. The message is encoded
+    once per change and shared by all subscribers.
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.version = 0
+        self._message: Tuple[int, str] = (-1, "")
+
+    def emit(self, study: str, kind: str) -> None:
+        """Count a `kind` event; `study` has to be capped by `REGISTRY.study_label`."""
+        counts = self.counts.get(study)
+        if counts is None:
+            counts = self.counts.setdefault(study, dict.fromkeys(EVENT_KINDS, 0))
+        counts[kind] += 1
+        self.version += 1
+
+    def message(self) -> Tuple[int, str]:
+        """The current counts as server-sent event, with their version."""
+        version = self.version
+        if self._message[0] != version:
+            # copy, counts may be emitted from threadpool workers meanwhile
+            data = json.dumps({s: dict(c) for s, c in list(self.counts.items())})
+            self._message = (version, f"data: {data}\n\n")
+        return self._message
+
+    async def stream(
+        self,
+        interval: float = PUSH_INTERVAL,
+        keepalive: float = KEEPALIVE_INTERVAL,
+    ) -> AsyncIterator[str]:
+        """Server-sent events with the counts, whenever they change."""
+        last_version = None
+        idle = 0.0
+        while True:
+            version, message = self.message()
+            if version != last_version:
+                last_version = version
+                idle = 0.0
+                yield message
+            elif idle >= keepalive:
+                idle = 0.0
+                yield ": keepalive\n\n"
+            await asyncio.sleep(interval)
+            idle += interval
+
+
+MONITOR = SubmissionMonitor()
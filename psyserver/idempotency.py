@@ -0,0 +1,96 @@
+import asyncio
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from psyserver.db import get_idempotent_response_db, set_idempotent_response_db
+from psyserver.settings import get_settings_toml
+from psyserver.tracing import span
+
+
+class IdempotencyCache:
+    """Responses of already handled submissions, keyed by idempotency key.
+
+    Recent responses are kept in a bounded in-memory LRU cache. Every entry is
+    also stored in counter.db, so retries arriving after an eviction or a
+    restart are still answered with the original response. Retries arriving
+    while the original submission is still being handled wait for its
+    response, see `reserve`.
+
+    At most `idempotency_max_entries` responses are kept in memory, and
+    responses are forgotten after `idempotency_ttl` seconds. Both are read
+    from the current settings, so changes apply without a restart.
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict[Tuple[str, str], Tuple[float, Dict]] = OrderedDict()
+        self._in_flight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def get(self, study: str, key: str) -> Optional[Dict]:
+        """Return the original response for `key`, or None if unseen."""
+        now = time.time()
+        ttl = get_settings_toml().idempotency_ttl
+        entry = self._entries.get((study, key))
+        if entry is not None:
+            created, response = entry
+            if created >= now - ttl:
+                self._entries.move_to_end((study, key))
+                return response
+            del self._entries[(study, key)]
+
+        with span("idempotency"):
+            stored = get_idempotent_response_db(study, key, now - ttl)
+        if stored is None:
+            return None
+        response = json.loads(stored[0])
+        self._remember(study, key, stored[1], response)
+        return response
+
+    async def reserve(self, study: str, key: str) -> Optional[Dict]:
+        """Return the original response for `key`, or reserve the key.
+
+        If another request with `key` is in flight, waits for it to finish.
+        When None is returned, the caller handles the submission and has to
+        call `release` once done, after `put` on success.
+        """
+        while True:
+            response = self.get(study, key)
+            if response is not None:
+                return response
+            in_flight = self._in_flight.get((study, key))
+            if in_flight is None:
+                self._in_flight[(study, key)] = (
+                    asyncio.get_running_loop().create_future()
+                )
+                return None
+            # the first request may have failed, then check again
+            await asyncio.shield(in_flight)
+
+    def release(self, study: str, key: str) -> None:
+        """Wake requests waiting for the reserved `key`."""
+        in_flight = self._in_flight.pop((study, key), None)
+        if in_flight is not None and not in_flight.done():
+            in_flight.set_result(None)
+
+    def put(self, study: str, key: str, response: Dict) -> None:
+        """Record the response for `key`."""
+        now = time.time()
+        ttl = get_settings_toml().idempotency_ttl
+        try:
+            with span("idempotency"):
+                set_idempotent_response_db(
+                    study, key, json.dumps(response), now, now - ttl
+                )
+        except sqlite3.OperationalError as error:
+            # the submission is saved, retries are still answered from memory
+            print(f"ERROR: storing idempotency key {key!r} of {study} failed: {error}")
+        self._remember(study, key, now, response)
+
+    def _remember(self, study: str, key: str, created: float, response: Dict):
+        self._entries[(study, key)] = (created, response)
+        self._entries.move_to_end((study, key))
+        max_entries = get_settings_toml().idempotency_max_entries
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,197 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+from starlette.routing import BaseRoute, Match
+
+from psyserver.settings import Settings, get_settings_toml, get_study_settings
+from psyserver.tracing import span
+
+# number of idle clients/studies whose buckets are remembered
+MAX_BUCKETS = 100_000
+WRITE_ROUTES = ("/{study}/save", "/{study}/save_audio")
+LIMITED_ROUTES = (*WRITE_ROUTES, "/{study}/get_count", "/{study}/set_count/{count}")
+
+
+def too_many_requests(retry_after: float, detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class TokenBucket:
+    """Allows `rate` requests per second with bursts of up to `burst`."""
+
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token. Returns 0 on success, else seconds until one is free."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets per key, the least recently used are forgotten first."""
+
+    def __init__(self, max_buckets: int = MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets: OrderedDict[Tuple[str, str], TokenBucket] = OrderedDict()
+
+    def take(self, key: Tuple[str, str], rate: float, burst: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            # limits may have been reconfigured
+            bucket.rate, bucket.burst = rate, burst
+        return bucket.take()
+
+
+class WriteLimiter:
+    """Caps concurrent writes, with a bounded queue of waiting requests."""
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def acquire(self, max_queue: int, timeout: float) -> None:
+        if self._semaphore.locked():
+            if self.waiting >= max_queue:
+                raise too_many_requests(timeout, "Server busy, retry later.")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            except TimeoutError:
+                raise too_many_requests(timeout, "Server busy, retry later.")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+
+class AdmissionControl:
+    """Rate limits per client and study, and a global cap on writes.
+
+    All limits are disabled unless configured in `psyserver.toml`. Rate limits
+    can be overridden per study in `[psyserver.studies.<study>]`. The number of
+    concurrent writes is fixed at startup.
+    """
+
+    def __init__(self, settings: Settings):
+        self.rate_limiter = RateLimiter()
+        self.write_limiter = None
+        if settings.max_concurrent_writes is not None:
+            self.write_limiter = WriteLimiter(settings.max_concurrent_writes)
+
+    def check_rate(self, study: str, client: Optional[str]) -> None:
+        """Raise 429 if the client or study is above its rate."""
+        settings = get_study_settings(study)
+        if settings.rate_limit_client is not None and client is not None:
+            retry_after = self.rate_limiter.take(
+                ("client", client),
+                settings.rate_limit_client,
+                settings.rate_limit_client_burst,
+            )
+            if retry_after:
+                raise too_many_requests(retry_after, "Too many requests.")
+
+        if settings.rate_limit_study is not None:
+            retry_after = self.rate_limiter.take(
+                ("study", study),
+                settings.rate_limit_study,
+                settings.rate_limit_study_burst,
+            )
+            if retry_after:
+                raise too_many_requests(retry_after, "Too many requests for study.")
+
+    async def acquire_write(self) -> bool:
+        """Wait for a write slot, returns whether one has to be released."""
+        if self.write_limiter is None:
+            return False
+        settings = get_settings_toml()
+        with span("queue"):
+            await self.write_limiter.acquire(
+                settings.max_write_queue, settings.write_queue_timeout
+            )
+        return True
+
+    def release_write(self) -> None:
+        self.write_limiter.release()
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying `AdmissionControl` to the limited routes.
+
+    Requests are rejected or queued before their body is received, so limited
+    clients cost neither parsing nor receiving uploads, and
+    `max_concurrent_writes` caps the uploads in progress.
+    """
+
+    def __init__(self, app, admission: AdmissionControl, routes: List[BaseRoute]):
+        self.app = app
+        self.admission = admission
+        # the app's routes, matched to find the study of a request
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route_scope = self._match(scope)
+        if route_scope is None:
+            return await self.app(scope, receive, send)
+
+        client = scope["client"][0] if scope.get("client") else None
+        try:
+            self.admission.check_rate(route_scope["path_params"]["study"], client)
+            is_write = route_scope["route"].path in WRITE_ROUTES
+            holds_slot = is_write and await self.admission.acquire_write()
+        except HTTPException as error:
+            # lets the metrics label the rejection with its route and study
+            scope.update(route_scope)
+            response = JSONResponse(
+                {"detail": error.detail},
+                status_code=error.status_code,
+                headers=error.headers,
+            )
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if holds_slot:
+                self.admission.release_write()
+
+    def _match(self, scope) -> Optional[Dict]:
+        for route in self.routes:
+            if getattr(route, "path", None) not in LIMITED_ROUTES:
+                continue
+            match, route_scope = route.matches(scope)
+            if match == Match.FULL:
+                return route_scope
+        return None
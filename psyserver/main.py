@@ -1,19 +1,54 @@
+import asyncio
 import json
 import shutil
 import subprocess
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
 from typing import Dict, List, Union
 
 import requests
-from fastapi import Depends, FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    FastAPI,
+    File,
+    Form,
+    Header,
+    HTTPException,
+    UploadFile,
+)
 from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing_extensions import Annotated
 
-from psyserver.db import get_increment_study_count_db, set_study_count_db
-from psyserver.settings import Settings, get_settings_toml
+from psyserver.db import (
+    create_idempotency_table,
+    get_increment_study_count_db,
+    set_study_count_db,
+)
+from psyserver.events import MONITOR
+from psyserver.idempotency import IdempotencyCache
+from psyserver.limits import AdmissionControl, AdmissionMiddleware
+from psyserver.media import MediaPipeline
+from psyserver.metrics import (
+    BYTES_WRITTEN,
+    HCAPTCHA_DURATION,
+    HCAPTCHA_RESULTS,
+    REGISTRY,
+    STUDY_DISK_BYTES,
+    WRITE_QUEUE_DEPTH,
+    WRITES_ACTIVE,
+    MetricsMiddleware,
+    measure_event_loop_lag,
+)
+from psyserver.schema import SchemaCache, SchemaViolation
+from psyserver.settings import Settings, get_settings_toml, get_study_settings
+from psyserver.storage import create_storage
+from psyserver.tracing import TraceMiddleware, mark_since_start, span
+from psyserver.usage import USAGE, check_quota, seed_usage
 
 NOT_FOUND_HTML = """\
 <div style="display:flex;flex-direction:column;justify-content:center;
@@ -26,6 +61,7 @@ class StudyData(BaseModel, extra="allow"):
     participant_id: str | None = None
     session_dir: str | None = None
     h_captcha_response: str | None = None
+    idempotency_key: str | None = None
 
     model_config = {
         "json_schema_extra": {
@@ -70,42 +106,101 @@ class StudyDataCsv(BaseModel):
     }
 
 
-def check_path_escape_and_create_dir(
-    base_path: Path, test_path: Path, is_file: bool = False
-) -> None:
+def check_path_escape(base_path: Path, test_path: Path) -> None:
     """Raise error if test_path escapes the base directory."""
-    if not test_path.resolve().is_relative_to(base_path.resolve()):
-        raise HTTPException(status_code=400, detail="Invalid path component.")
-    if not is_file and not test_path.exists():
-        test_path.mkdir(parents=True, exist_ok=True)
+    with span("path"):
+        if not test_path.resolve().is_relative_to(base_path.resolve()):
+            raise HTTPException(status_code=400, detail="Invalid path component.")
 
 
-def create_app() -> FastAPI:
+def create_app(start_filebrowser: bool = True) -> FastAPI:
     # open filebrowser
-    filebrowser_path = shutil.which("filebrowser")
-    if filebrowser_path is None:
-        print("CRITICAL: Filebrowser not found. Please install filebrowser.")
-    else:
-        subprocess.Popen(
-            [filebrowser_path, "-c", "filebrowser.toml", "-r", "data"],
-            stdout=subprocess.PIPE,
-        )
+    if start_filebrowser:
+        filebrowser_path = shutil.which("filebrowser")
+        if filebrowser_path is None:
+            print("CRITICAL: Filebrowser not found. Please install filebrowser.")
+        else:
+            subprocess.Popen(
+                [filebrowser_path, "-c", "filebrowser.toml", "-r", "data"],
+                stdout=subprocess.PIPE,
+            )
 
-    # server
-    app = FastAPI()
     settings = get_settings_toml()
+    storage = create_storage(settings)
+    media = MediaPipeline(settings.media_jobs_db, settings.media_workers)
+    # counter.db may predate idempotency keys
+    create_idempotency_table()
+
+    def report_seed_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            print(f"ERROR: counting disk usage failed: {task.exception()!r}")
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        lag_task = asyncio.create_task(measure_event_loop_lag())
+        await storage.start()
+        media.resume()
+        usage_task = None
+        if settings.storage != "s3":
+            # counts of the existing data, quotas only see new saves until done
+            usage_task = asyncio.create_task(
+                asyncio.to_thread(seed_usage, USAGE, storage, settings.data_dir)
+            )
+            usage_task.add_done_callback(report_seed_failure)
+        yield
+        if usage_task is not None and not usage_task.done():
+            usage_task.cancel()
+        media.stop()
+        await storage.stop()
+        lag_task.cancel()
+
+    # server
+    app = FastAPI(lifespan=lifespan)
+    admission = AdmissionControl(settings)
+    app.add_middleware(
+        AdmissionMiddleware, admission=admission, routes=app.router.routes
+    )
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(TraceMiddleware)
+    idempotency_cache = IdempotencyCache()
+    schemas = SchemaCache()
+
+    def update_write_gauges():
+        if admission.write_limiter is not None:
+            WRITE_QUEUE_DEPTH.labels().set(admission.write_limiter.waiting)
+            WRITES_ACTIVE.labels().set(admission.write_limiter.active)
+
+    REGISTRY.on_render("write_limiter", update_write_gauges)
+
+    def update_usage_gauges():
+        for study, totals in list(USAGE.studies.items()):
+            STUDY_DISK_BYTES.labels(REGISTRY.study_label(study)).set(totals[0])
+
+    REGISTRY.on_render("usage", update_usage_gauges)
 
     @app.post("/{study}/save")
     async def save_data(
         study: str,
         study_data: StudyData,
-        settings: Annotated[Settings, Depends(get_settings_toml)],
+        settings: Annotated[Settings, Depends(get_study_settings)],
+        idempotency_key: Annotated[str | None, Header()] = None,
     ) -> Dict[str, Union[bool, str]]:
-        """Save submitted json object to file."""
+        """Save submitted json object to file.
+
+        Retries carrying the same idempotency key (header or field) as an
+        earlier submission get the original response and are not saved again.
+        """
+        mark_since_start("parse")
+        idempotency_key = idempotency_key or study_data.idempotency_key
+        if idempotency_key is not None:
+            original_response = idempotency_cache.get(study, idempotency_key)
+            if original_response is not None:
+                return original_response
+
         ret_json: Dict[str, Union[bool, str]] = {"success": True}
         base_path = Path(settings.data_dir)
         data_dir = base_path / study
-        check_path_escape_and_create_dir(base_path, data_dir)
+        check_path_escape(base_path, data_dir)
 
         ret_json["status"] = ""
 
@@ -123,10 +218,26 @@ def create_app() -> FastAPI:
             )
         study_data_to_save = study_data.model_dump(exclude_none=True)
 
+        # Validate against the study's schema.json
+        validate = schemas.get(Path(settings.studies_dir), study)
+        if validate is not None:
+            try:
+                with span("validate"):
+                    # as sent: keeps explicit nulls, skips fields not sent
+                    validate(study_data.model_dump(exclude_unset=True))
+            except SchemaViolation as violation:
+                if settings.schema_mode == "reject":
+                    raise HTTPException(
+                        status_code=422,
+                        detail=f"Data does not match schema: {violation}",
+                    )
+                ret_json["status"] += f" schema: {violation}"
+                study_data_to_save["schema_violation"] = str(violation)
+
         # Deal with session_dir
         if study_data.session_dir is not None:
             data_dir = data_dir / study_data.session_dir
-            check_path_escape_and_create_dir(base_path, data_dir)
+            check_path_escape(base_path, data_dir)
 
         # Deal with hcaptcha response
         if study_data.h_captcha_response is not None:
@@ -134,13 +245,21 @@ def create_app() -> FastAPI:
                 ret_json["status"] += " h_captcha_verification: secret missing"
                 study_data_to_save["h_captcha_verification"] = "secret missing"
             else:
-                response = requests.post(
-                    settings.h_captcha_verify_url,
-                    data=dict(
-                        secret=settings.h_captcha_secret,
-                        response=study_data.h_captcha_response,
-                    ),
-                )
+                start = time.perf_counter()
+                try:
+                    with span("hcaptcha"):
+                        response = requests.post(
+                            settings.h_captcha_verify_url,
+                            data=dict(
+                                secret=settings.h_captcha_secret,
+                                response=study_data.h_captcha_response,
+                            ),
+                        )
+                except requests.RequestException:
+                    HCAPTCHA_RESULTS.labels("request error").inc()
+                    raise
+                finally:
+                    HCAPTCHA_DURATION.labels().observe(time.perf_counter() - start)
                 if response.status_code == 200:
                     suc = response.json()["success"]
                     study_data_to_save["h_captcha_verification"] = (
@@ -148,6 +267,9 @@ def create_app() -> FastAPI:
                     )
                 else:
                     study_data_to_save["h_captcha_verification"] = "verification failed"
+                HCAPTCHA_RESULTS.labels(
+                    study_data_to_save["h_captcha_verification"]
+                ).inc()
 
         else:
             ret_json["status"] += " h_captcha_verification: h_captcha_response missing"
@@ -159,29 +281,44 @@ def create_app() -> FastAPI:
         # Save data
         now = str(datetime.now())[:19].replace(":", "-").replace(" ", "_")
         filepath = data_dir / f"{participantID}{now}.json"
-        check_path_escape_and_create_dir(base_path, filepath, is_file=True)
-
-        with open(filepath, "w") as f_out:
-            json.dump(study_data_to_save, f_out)
+        check_path_escape(base_path, filepath)
+
+        with span("serialize"):
+            serialized = json.dumps(study_data_to_save)
+        quota_warning = check_quota(USAGE, study, len(serialized), settings)
+        with span("write"):
+            replaced = storage.write(
+                base_path, filepath.relative_to(base_path).as_posix(), serialized
+            )
+        USAGE.add(study, study_data.session_dir, len(serialized), replaced)
+        if quota_warning is not None:
+            ret_json["status"] = ret_json.get("status", "") + quota_warning
+        BYTES_WRITTEN.labels(REGISTRY.study_label(study), "json").inc(len(serialized))
+
+        if idempotency_key is not None:
+            idempotency_cache.put(study, idempotency_key, ret_json)
+        MONITOR.emit(REGISTRY.study_label(study), "save")
         return ret_json
 
-    @app.post("/{study}/save_audio")
-    async def save_audio(
+    async def store_audio(
         study: str,
-        audio_data: Annotated[UploadFile, File()],
-        settings: Annotated[Settings, Depends(get_settings_toml)],
-        session_dir: Annotated[str | None, Form()] = None,
+        audio_data: UploadFile,
+        settings: Settings,
+        background_tasks: BackgroundTasks,
+        session_dir: str | None,
+        idempotency_key: str | None,
     ) -> Dict[str, Union[bool, str]]:
-        """Save audio data uploaded as UploadFile."""
-
+        """Save the uploaded file, for `save_audio`."""
         base_path = Path(settings.data_dir)
         data_dir = base_path / study
-        check_path_escape_and_create_dir(base_path, data_dir)
+        check_path_escape(base_path, data_dir)
 
         if audio_data.filename is None:
+            MONITOR.emit(REGISTRY.study_label(study), "error")
             return {"success": False, "error": "audio_data.filename is None"}
         filename_parts = audio_data.filename.split(".")
         if len(filename_parts) != 2:
+            MONITOR.emit(REGISTRY.study_label(study), "error")
             return {
                 "success": False,
                 "error": "audio_data.filename needs to only have one dot.",
@@ -193,13 +330,77 @@ def create_app() -> FastAPI:
             data_dir = data_dir / session_dir / "audio"
         else:
             data_dir = data_dir / "audio"
-        check_path_escape_and_create_dir(base_path, data_dir)
+        check_path_escape(base_path, data_dir)
 
         filepath = data_dir / filename
-        check_path_escape_and_create_dir(base_path, filepath, is_file=True)
-        with open(filepath, "wb") as f_out:
-            f_out.write(await audio_data.read())
-        return {"success": True, "filename": filename}
+        check_path_escape(base_path, filepath)
+        with span("read"):
+            content = await audio_data.read()
+        quota_warning = check_quota(USAGE, study, len(content), settings)
+        with span("write"):
+            replaced = storage.write(
+                base_path, filepath.relative_to(base_path).as_posix(), content
+            )
+        USAGE.add(study, session_dir, len(content), replaced)
+        BYTES_WRITTEN.labels(REGISTRY.study_label(study), "audio").inc(len(content))
+        # processing needs the file on the local disk
+        if settings.media_steps and settings.storage == "filesystem":
+            background_tasks.add_task(
+                media.enqueue,
+                study,
+                filepath,
+                list(settings.media_steps),
+                {
+                    "sample_rate": settings.media_sample_rate,
+                    "silence_threshold": settings.media_silence_threshold,
+                },
+            )
+
+        ret_json: Dict[str, Union[bool, str]] = {"success": True, "filename": filename}
+        if quota_warning is not None:
+            ret_json["status"] = quota_warning
+        if idempotency_key is not None:
+            idempotency_cache.put(study, idempotency_key, ret_json)
+        MONITOR.emit(REGISTRY.study_label(study), "audio")
+        return ret_json
+
+    @app.post("/{study}/save_audio")
+    async def save_audio(
+        study: str,
+        audio_data: Annotated[UploadFile, File()],
+        settings: Annotated[Settings, Depends(get_study_settings)],
+        background_tasks: BackgroundTasks,
+        session_dir: Annotated[str | None, Form()] = None,
+        idempotency_key: Annotated[str | None, Header()] = None,
+        idempotency_key_form: Annotated[
+            str | None, Form(alias="idempotency_key")
+        ] = None,
+    ) -> Dict[str, Union[bool, str]]:
+        """Save audio data uploaded as UploadFile.
+
+        Retries carrying the same idempotency key (header or form field) as an
+        earlier upload get the original response and are not saved again. The
+        configured `media_steps` run on the saved file after the response.
+        """
+        mark_since_start("parse")
+        idempotency_key = idempotency_key or idempotency_key_form
+        if idempotency_key is not None:
+            # retries arriving during the upload wait for its response
+            original_response = await idempotency_cache.reserve(study, idempotency_key)
+            if original_response is not None:
+                return original_response
+        try:
+            return await store_audio(
+                study,
+                audio_data,
+                settings,
+                background_tasks,
+                session_dir,
+                idempotency_key,
+            )
+        finally:
+            if idempotency_key is not None:
+                idempotency_cache.release(study, idempotency_key)
 
     @app.get("/favicon.ico", include_in_schema=False)
     async def favicon():
@@ -209,7 +410,9 @@ def create_app() -> FastAPI:
     def get_increment_study_count(study: str):
         count, error = get_increment_study_count_db(study)
         if error is not None:
+            MONITOR.emit(REGISTRY.study_label(study), "error")
             return {"success": False, "count": None, "error": error}
+        MONITOR.emit(REGISTRY.study_label(study), "count")
         return {"success": True, "count": count}
 
     @app.get("/{study}/set_count/{count}")
@@ -224,6 +427,7 @@ def create_app() -> FastAPI:
 
     @app.exception_handler(404)
     async def custom_404_handler(_, __):
+        settings = get_settings_toml()
         if settings.redirect_url is not None:
             return RedirectResponse(settings.redirect_url)
         return HTMLResponse(NOT_FOUND_HTML)
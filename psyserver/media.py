@@ -0,0 +1,279 @@
+import json
+import multiprocessing
+import sqlite3
+import threading
+import time
+import warnings
+import wave
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from psyserver.archive import sha256_file
+from psyserver.db import SQLite
+
+MEDIA_STEPS = ("checksum", "info", "trim_silence", "resample")
+PROCESSED_DIR_NAME = "processed"
+# length of the windows in which silence is detected
+SILENCE_WINDOW = 0.01
+
+
+def _audioop():
+    # deprecated since python 3.11, but the only resampler in the stdlib
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+    return audioop
+
+
+def _read_wav(path: Path) -> Tuple[wave._wave_params, bytes]:
+    with wave.open(str(path), "rb") as f_wav:
+        return f_wav.getparams(), f_wav.readframes(f_wav.getnframes())
+
+
+def _write_wav(path: Path, params: wave._wave_params, frames: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with wave.open(str(path), "wb") as f_wav:
+        f_wav.setnchannels(params.nchannels)
+        f_wav.setsampwidth(params.sampwidth)
+        f_wav.setframerate(params.framerate)
+        f_wav.writeframes(frames)
+
+
+def _trim_silence(params: wave._wave_params, frames: bytes, threshold: int) -> bytes:
+    audioop = _audioop()
+    frame_size = params.nchannels * params.sampwidth
+    window = max(1, int(params.framerate * SILENCE_WINDOW)) * frame_size
+    loud = [
+        offset
+        for offset in range(0, len(frames), window)
+        if audioop.rms(frames[offset : offset + window], params.sampwidth) >= threshold
+    ]
+    if not loud:
+        return b""
+    return frames[loud[0] : loud[-1] + window]
+
+
+def process_media(path: str, steps: List[str], options: Dict) -> Dict:
+    """Run the post-processing `steps` on the uploaded file at `path`.
+
+    Runs in a worker process. Steps modifying audio (`trim_silence`,
+    `resample`) only support WAV files and write their output to a `processed`
+    directory next to the upload, the upload itself is never changed.
+
+    Returns
+    -------
+    result : dict
+        Results of the steps, e.g. `sha256`, `duration` and `sample_rate`.
+    """
+    source = Path(path)
+    result: Dict = {}
+    if "checksum" in steps:
+        result["sha256"] = sha256_file(source)
+
+    audio_steps = [step for step in steps if step != "checksum"]
+    if not audio_steps:
+        return result
+    if source.suffix.lower() != ".wav":
+        raise ValueError(f"steps {audio_steps} require a .wav file.")
+
+    params, frames = _read_wav(source)
+    if "info" in steps:
+        result["duration"] = params.nframes / params.framerate
+        result["sample_rate"] = params.framerate
+        result["channels"] = params.nchannels
+        result["sample_width"] = params.sampwidth
+
+    modified = False
+    if "trim_silence" in steps:
+        frames = _trim_silence(params, frames, options["silence_threshold"])
+        result["trimmed_duration"] = len(frames) / (
+            params.framerate * params.nchannels * params.sampwidth
+        )
+        modified = True
+    if "resample" in steps and params.framerate != options["sample_rate"]:
+        frames, _ = _audioop().ratecv(
+            frames,
+            params.sampwidth,
+            params.nchannels,
+            params.framerate,
+            options["sample_rate"],
+            None,
+        )
+        params = params._replace(framerate=options["sample_rate"])
+        modified = True
+
+    if modified:
+        output = source.parent / PROCESSED_DIR_NAME / source.name
+        _write_wav(output, params, frames)
+        result["processed_path"] = str(output)
+    return result
+
+
+class MediaPipeline:
+    """Post-processing of uploaded media files on a process pool.
+
+    Jobs are persisted in a SQLite file before they are handed to the pool, so
+    jobs that were pending or running when the server stopped are picked up
+    again by `resume`. Results are stored with the job and can be queried with
+    `get_media_jobs`. The pool is only started once there is a job.
+    """
+
+    def __init__(self, db_path: Path | str, workers: int = 2):
+        # results arrive in a pool thread, independent of the working directory
+        self.db_path = Path(db_path).resolve()
+        self.workers = workers
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.futures: Dict[int, Future] = {}
+        # guards pool and futures; enqueue runs in threadpool workers and results
+        # arrive in a pool thread
+        self._lock = threading.Condition()
+        self._table_created = False
+
+    def resume(self) -> None:
+        """Submit jobs left unfinished by a previous run."""
+        if not self.db_path.exists():
+            return
+        self._ensure_table()
+        with SQLite(self.db_path) as conn:
+            res = conn.execute(
+                "SELECT id, path, steps, options FROM media_jobs"
+                " WHERE status IN ('pending', 'running') ORDER BY id"
+            )
+            unfinished = res.fetchall()
+        for job_id, path, steps, options in unfinished:
+            self._submit(job_id, path, json.loads(steps), json.loads(options))
+
+    def stop(self) -> None:
+        """Stop the pool; unfinished jobs stay in the database."""
+        with self._lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
+    def enqueue(
+        self, study: str, path: Path | str, steps: List[str], options: Dict
+    ) -> None:
+        """Persist a job for the file at `path` and hand it to the pool."""
+        self._ensure_table()
+        now = time.time()
+        with SQLite(self.db_path) as conn:
+            cur = conn.execute(
+                "INSERT INTO media_jobs"
+                " (study, path, steps, options, status, created, updated)"
+                " VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+                (study, str(path), json.dumps(steps), json.dumps(options), now, now),
+            )
+            conn.commit()
+            job_id = cur.lastrowid
+        self._submit(job_id, str(path), steps, options)
+
+    def wait(self) -> None:
+        """Block until all submitted jobs are finished and recorded."""
+        with self._lock:
+            self._lock.wait_for(lambda: not self.futures)
+
+    def _ensure_table(self) -> None:
+        if not self._table_created:
+            create_media_jobs_table(self.db_path)
+            self._table_created = True
+
+    def _submit(self, job_id: int, path: str, steps: List[str], options: Dict):
+        self._update(job_id, "running")
+        with self._lock:
+            if self.pool is None:
+                # spawn, forking a process running threads is unsafe
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            try:
+                future = self.pool.submit(process_media, path, steps, options)
+            except BrokenProcessPool:
+                # a worker died, e.g. killed for memory; start a fresh pool
+                self.pool.shutdown(wait=False)
+                self.pool = None
+                self._submit(job_id, path, steps, options)
+                return
+            self.futures[job_id] = future
+        future.add_done_callback(lambda future: self._done(job_id, future))
+
+    def _done(self, job_id: int, future: Future) -> None:
+        # cancelled by shutting down before the job ran, resumed on next start
+        if not future.cancelled():
+            error = future.exception()
+            if error is not None:
+                self._update(job_id, "failed", error=f"{type(error).__name__}: {error}")
+            else:
+                self._update(job_id, "done", result=future.result())
+        with self._lock:
+            self.futures.pop(job_id, None)
+            self._lock.notify_all()
+
+    def _update(
+        self,
+        job_id: int,
+        status: str,
+        result: Optional[Dict] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        with SQLite(self.db_path) as conn:
+            conn.execute(
+                "UPDATE media_jobs SET status=?, result=?, error=?, updated=?"
+                " WHERE id=?",
+                (
+                    status,
+                    None if result is None else json.dumps(result),
+                    error,
+                    time.time(),
+                    job_id,
+                ),
+            )
+            conn.commit()
+
+
+def create_media_jobs_table(db_path: Path) -> None:
+    with SQLite(db_path) as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media_jobs (
+                id INTEGER PRIMARY KEY,
+                study TEXT,
+                path TEXT,
+                steps TEXT,
+                options TEXT,
+                status TEXT,
+                result TEXT,
+                error TEXT,
+                created REAL,
+                updated REAL
+            );"""
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS media_jobs_study ON media_jobs (study, path);"
+        )
+        conn.commit()
+
+
+def get_media_jobs(db_path: Path | str, study: str) -> List[Dict]:
+    """Jobs and their results for the uploads of `study`."""
+    db_path = Path(db_path)
+    if not db_path.exists():
+        return []
+    with SQLite(db_path) as conn:
+        conn.row_factory = sqlite3.Row
+        res = conn.execute(
+            "SELECT path, steps, status, result, error, created, updated"
+            " FROM media_jobs WHERE study=? ORDER BY id",
+            (study,),
+        )
+        rows = res.fetchall()
+    return [
+        {
+            **dict(row),
+            "steps": json.loads(row["steps"]),
+            "result": None if row["result"] is None else json.loads(row["result"]),
+        }
+        for row in rows
+    ]
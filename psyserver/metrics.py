@@ -0,0 +1,282 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+from psyserver.events import MONITOR
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# studies are taken from the url, so their number has to be capped
+MAX_STUDY_LABELS = 1000
+OTHER_STUDY = "other"
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self, name: str, labels: str) -> List[str]:
+        return [f"{name}{labels} {self.value}"]
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        label_prefix = labels[:-1] + "," if labels else "{"
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{label_prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{label_prefix}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class MetricFamily:
+    """A metric with one child per combination of label values."""
+
+    def __init__(
+        self, name: str, help: str, kind: type, labelnames: Tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = labelnames
+        self.children: Dict[Tuple[str, ...], Counter | Histogram] = {}
+        if not labelnames:
+            self.children[()] = kind()
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.kind()
+        return child
+
+    def render(self) -> List[str]:
+        type_name = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {type_name[self.kind]}",
+        ]
+        for values, child in list(self.children.items()):
+            labels = ""
+            if values:
+                pairs = (
+                    f'{name}="{_escape(value)}"'
+                    for name, value in zip(self.labelnames, values)
+                )
+                labels = "{" + ",".join(pairs) + "}"
+            lines.extend(child.samples(self.name, labels))
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    """In-process metrics, rendered in the Prometheus text format.
+
+    Metrics are plain python objects updated without locks. Histograms
+    preallocate their bucket counts, so an observation is a bisect and two
+    additions.
+    """
+
+    def __init__(self):
+        self.families: Dict[str, MetricFamily] = {}
+        self.callbacks: Dict[str, Callable[[], None]] = {}
+        self.studies: set = set()
+
+    def register(self, family: MetricFamily) -> MetricFamily:
+        self.families[family.name] = family
+        return family
+
+    def on_render(self, name: str, callback: Callable[[], None]) -> None:
+        """Register a callback that updates gauges right before rendering."""
+        self.callbacks[name] = callback
+
+    def study_label(self, study: Optional[str]) -> str:
+        if study is None:
+            return ""
+        if study not in self.studies:
+            if len(self.studies) >= MAX_STUDY_LABELS:
+                return OTHER_STUDY
+            self.studies.add(study)
+        return study
+
+    def render(self) -> str:
+        for callback in list(self.callbacks.values()):
+            callback()
+        lines = []
+        for family in self.families.values():
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(
+    MetricFamily(
+        "psyserver_request_duration_seconds",
+        "Request latency per route and study.",
+        Histogram,
+        ("route", "study"),
+    )
+)
+RESPONSES = REGISTRY.register(
+    MetricFamily(
+        "psyserver_responses_total",
+        "Responses per route and status code.",
+        Counter,
+        ("route", "status"),
+    )
+)
+BYTES_WRITTEN = REGISTRY.register(
+    MetricFamily(
+        "psyserver_bytes_written_total",
+        "Bytes of study data written to disk per study.",
+        Counter,
+        ("study", "kind"),
+    )
+)
+COUNTER_DB_DURATION = REGISTRY.register(
+    MetricFamily(
+        "psyserver_counter_db_duration_seconds",
+        "Latency of the SQLite participant counter.",
+        Histogram,
+        ("operation",),
+    )
+)
+HCAPTCHA_DURATION = REGISTRY.register(
+    MetricFamily(
+        "psyserver_hcaptcha_duration_seconds",
+        "Latency of hCaptcha verification requests.",
+        Histogram,
+    )
+)
+HCAPTCHA_RESULTS = REGISTRY.register(
+    MetricFamily(
+        "psyserver_hcaptcha_verifications_total",
+        "hCaptcha verification results.",
+        Counter,
+        ("result",),
+    )
+)
+WRITE_QUEUE_DEPTH = REGISTRY.register(
+    MetricFamily(
+        "psyserver_write_queue_depth",
+        "Write requests waiting for a write slot.",
+        Gauge,
+    )
+)
+WRITES_ACTIVE = REGISTRY.register(
+    MetricFamily(
+        "psyserver_writes_active",
+        "Write requests currently holding a write slot.",
+        Gauge,
+    )
+)
+STUDY_DISK_BYTES = REGISTRY.register(
+    MetricFamily(
+        "psyserver_study_disk_bytes",
+        "Bytes of saved data per study.",
+        Gauge,
+        ("study",),
+    )
+)
+EVENT_LOOP_LAG = REGISTRY.register(
+    MetricFamily(
+        "psyserver_event_loop_lag_seconds",
+        "Delay of the event loop in waking up a sleeping task.",
+        Histogram,
+    )
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and status of every request."""
+
+    def __init__(self, app, registry: Registry = REGISTRY):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            route = scope.get("route")
+            if route is not None:
+                route_label = route.path
+            elif status < 400:
+                route_label = "static"
+            else:
+                route_label = "unmatched"
+            study = self.registry.study_label(scope.get("path_params", {}).get("study"))
+            REQUEST_DURATION.labels(route_label, study).observe(duration)
+            RESPONSES.labels(route_label, str(status)).inc()
+            if study and status >= 400:
+                MONITOR.emit(study, "error")
+
+
+async def measure_event_loop_lag(interval: float = EVENT_LOOP_LAG_INTERVAL):
+    """Record how late the event loop wakes up from `interval` long sleeps."""
+    histogram = EVENT_LOOP_LAG.labels()
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, time.perf_counter() - start - interval))
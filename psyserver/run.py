@@ -1,3 +1,4 @@
+import asyncio
 import os
 import tomllib
 from pathlib import Path
@@ -30,4 +31,24 @@ def run_server(psyserver_dir: Path | str | None = None):
         "psyserver.main:create_app", factory=True, **config["uvicorn"]
     )
     server = uvicorn.Server(uvicorn_config)
-    server.run()
+    if "admin" not in config:
+        server.run()
+        return
+
+    # admin routes (metrics, ...) are served on a separate, internal interface
+    admin_config = uvicorn.Config(
+        "psyserver.admin:create_admin_app", factory=True, **config["admin"]
+    )
+    admin_server = uvicorn.Server(admin_config)
+    # the event loop uvicorn would use, e.g. uvloop
+    with asyncio.Runner(loop_factory=uvicorn_config.get_loop_factory()) as runner:
+        runner.run(_serve_together(server, admin_server))
+
+
+async def _serve_together(*servers: uvicorn.Server):
+    """Serve multiple servers in one event loop, stopping all if one stops."""
+    tasks = [asyncio.create_task(server.serve()) for server in servers]
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for server in servers:
+        server.should_exit = True
+    await asyncio.gather(*tasks)
@@ -0,0 +1,412 @@
+import json
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+SCHEMA_FILE_NAME = "schema.json"
+# seconds between checks whether a schema file changed
+SCHEMA_POLL_INTERVAL = 1.0
+# studies are taken from the url, the least recently used are forgotten first
+MAX_SCHEMA_ENTRIES = 1000
+
+# keywords without effect on validation
+ANNOTATION_KEYWORDS = {
+    "$schema",
+    "$id",
+    "$comment",
+    "title",
+    "description",
+    "default",
+    "examples",
+}
+
+Validator = Callable[[Any], None]
+
+
+class SchemaError(ValueError):
+    """The schema is invalid or uses unsupported keywords."""
+
+
+class SchemaViolation(Exception):
+    """The validated value does not match the schema."""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+        # innermost key first
+        self.path: List[str | int] = []
+
+    def __str__(self) -> str:
+        location = "".join(f"[{key!r}]" for key in reversed(self.path))
+        return f"{location or 'data'}: {self.message}"
+
+
+def _is_integer(value: Any) -> bool:
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or (isinstance(value, float) and value.is_integer())
+
+
+def _json_equal(a: Any, b: Any) -> bool:
+    """Equality of json values, unlike `==` booleans never equal numbers."""
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a is b
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(map(_json_equal, a, b))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_json_equal(a[k], b[k]) for k in a)
+    return a == b
+
+
+TYPE_CHECKS: Dict[str, Callable[[Any], bool]] = {
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    "string": lambda value: isinstance(value, str),
+    "integer": _is_integer,
+    "number": lambda value: (
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+    ),
+    "boolean": lambda value: isinstance(value, bool),
+    "null": lambda value: value is None,
+}
+# types checked with a single isinstance call; int and float are left out, as
+# bool is a subclass of int
+EXACT_TYPES: Dict[str, tuple] = {
+    "object": (dict,),
+    "array": (list,),
+    "string": (str,),
+    "boolean": (bool,),
+}
+
+
+def _compile_type(types: str | List[str]) -> Validator:
+    if isinstance(types, str):
+        types = [types]
+    for name in types:
+        if name not in TYPE_CHECKS:
+            raise SchemaError(f"unknown type '{name}'.")
+    expected = " or ".join(types)
+
+    if all(name in EXACT_TYPES for name in types):
+        classes = tuple(cls for name in types for cls in EXACT_TYPES[name])
+
+        def check_exact(value: Any) -> None:
+            if not isinstance(value, classes):
+                raise SchemaViolation(f"expected {expected}.")
+
+        return check_exact
+
+    checks = [TYPE_CHECKS[name] for name in types]
+
+    def check_type(value: Any) -> None:
+        for check in checks:
+            if check(value):
+                return
+        raise SchemaViolation(f"expected {expected}.")
+
+    return check_type
+
+
+def _compile_object(schema: Dict, typed: bool) -> Optional[Validator]:
+    properties = {
+        key: compile_schema(subschema)
+        for key, subschema in schema.get("properties", {}).items()
+    }
+    required = list(schema.get("required", []))
+    additional = schema.get("additionalProperties", True)
+    if additional is True:
+        check_additional = None
+    elif additional is False:
+        check_additional = False
+    else:
+        check_additional = compile_schema(additional)
+    if not typed and not properties and not required and check_additional is None:
+        return None
+
+    def check_object(value: Any) -> None:
+        if not isinstance(value, dict):
+            if typed:
+                raise SchemaViolation("expected object.")
+            return
+        for key in required:
+            if key not in value:
+                raise SchemaViolation(f"missing required entry '{key}'.")
+        if not properties and check_additional is None:
+            return
+        for key, item in value.items():
+            check = properties.get(key, check_additional)
+            if check is None:
+                continue
+            if check is False:
+                raise SchemaViolation(f"entry '{key}' not allowed.")
+            try:
+                check(item)
+            except SchemaViolation as violation:
+                violation.path.append(key)
+                raise
+
+    return check_object
+
+
+def _compile_array(schema: Dict, typed: bool) -> Optional[Validator]:
+    check_items = compile_schema(schema["items"]) if "items" in schema else None
+    min_items = schema.get("minItems")
+    max_items = schema.get("maxItems")
+    if not typed and check_items is None and min_items is None and max_items is None:
+        return None
+
+    def check_array(value: Any) -> None:
+        if not isinstance(value, list):
+            if typed:
+                raise SchemaViolation("expected array.")
+            return
+        if min_items is not None and len(value) < min_items:
+            raise SchemaViolation(f"expected at least {min_items} items.")
+        if max_items is not None and len(value) > max_items:
+            raise SchemaViolation(f"expected at most {max_items} items.")
+        if check_items is not None:
+            index = 0
+            try:
+                for index, item in enumerate(value):
+                    check_items(item)
+            except SchemaViolation as violation:
+                violation.path.append(index)
+                raise
+
+    return check_array
+
+
+def _compile_string(schema: Dict, typed: bool) -> Optional[Validator]:
+    min_length = schema.get("minLength")
+    max_length = schema.get("maxLength")
+    pattern = re.compile(schema["pattern"]) if "pattern" in schema else None
+    if not typed and min_length is None and max_length is None and pattern is None:
+        return None
+
+    def check_string(value: Any) -> None:
+        if not isinstance(value, str):
+            if typed:
+                raise SchemaViolation("expected string.")
+            return
+        if min_length is not None and len(value) < min_length:
+            raise SchemaViolation(f"expected at least {min_length} characters.")
+        if max_length is not None and len(value) > max_length:
+            raise SchemaViolation(f"expected at most {max_length} characters.")
+        if pattern is not None and pattern.search(value) is None:
+            raise SchemaViolation(f"does not match '{pattern.pattern}'.")
+
+    return check_string
+
+
+def _compile_number(schema: Dict, typed: bool) -> Optional[Validator]:
+    integer = typed and schema["type"] in ("integer", ["integer"])
+    expected = "integer" if integer else "number"
+    minimum = schema.get("minimum")
+    maximum = schema.get("maximum")
+    exclusive_minimum = schema.get("exclusiveMinimum")
+    exclusive_maximum = schema.get("exclusiveMaximum")
+    bounded = any(
+        bound is not None
+        for bound in (minimum, maximum, exclusive_minimum, exclusive_maximum)
+    )
+    if not typed and not bounded:
+        return None
+
+    def check_number(value: Any) -> None:
+        # exact class checks, bool is a subclass of int
+        value_type = value.__class__
+        if value_type is not int and value_type is not float:
+            if typed:
+                raise SchemaViolation(f"expected {expected}.")
+            return
+        if integer and value_type is float and not value.is_integer():
+            raise SchemaViolation("expected integer.")
+        if not bounded:
+            return
+        if minimum is not None and value < minimum:
+            raise SchemaViolation(f"expected at least {minimum}.")
+        if maximum is not None and value > maximum:
+            raise SchemaViolation(f"expected at most {maximum}.")
+        if exclusive_minimum is not None and value <= exclusive_minimum:
+            raise SchemaViolation(f"expected greater than {exclusive_minimum}.")
+        if exclusive_maximum is not None and value >= exclusive_maximum:
+            raise SchemaViolation(f"expected less than {exclusive_maximum}.")
+
+    return check_number
+
+
+# compilers of the keywords applying to the given types; with `typed`, the
+# returned check also rejects other types, which saves a separate type check
+KEYWORD_COMPILERS: Tuple[
+    Tuple[Callable[[Dict, bool], Optional[Validator]], Tuple[str, ...]], ...
+] = (
+    (_compile_object, ("object",)),
+    (_compile_array, ("array",)),
+    (_compile_string, ("string",)),
+    (_compile_number, ("number", "integer")),
+)
+
+
+SUPPORTED_KEYWORDS = ANNOTATION_KEYWORDS | {
+    "type",
+    "enum",
+    "const",
+    "properties",
+    "required",
+    "additionalProperties",
+    "items",
+    "minItems",
+    "maxItems",
+    "minLength",
+    "maxLength",
+    "pattern",
+    "minimum",
+    "maximum",
+    "exclusiveMinimum",
+    "exclusiveMaximum",
+}
+
+
+def compile_schema(schema: Dict | bool) -> Validator:
+    """Compile a JSON Schema into a function raising `SchemaViolation`.
+
+    Supports the keywords in `SUPPORTED_KEYWORDS`, a subset of JSON Schema
+    draft 2020-12. All keywords are resolved once here, so validating is a
+    chain of closures without any lookups in the schema.
+    """
+    if schema is True or schema == {}:
+        return lambda value: None
+    if schema is False:
+
+        def reject(value: Any) -> None:
+            raise SchemaViolation("not allowed.")
+
+        return reject
+    if not isinstance(schema, dict):
+        raise SchemaError(f"schema has to be an object, got {schema!r}.")
+    unsupported = set(schema) - SUPPORTED_KEYWORDS
+    if unsupported:
+        raise SchemaError(f"unsupported keywords: {sorted(unsupported)}.")
+
+    checks: List[Validator] = []
+    single_type = schema.get("type")
+    if isinstance(single_type, list) and len(single_type) == 1:
+        single_type = single_type[0]
+    if "type" in schema and not any(
+        single_type in types for _, types in KEYWORD_COMPILERS
+    ):
+        checks.append(_compile_type(schema["type"]))
+    if "enum" in schema:
+        options = list(schema["enum"])
+        # `in` alone would let true match 1, so these compare type-strictly
+        strict = (bool, list, dict)
+        strict_options = any(isinstance(option, strict) for option in options)
+
+        def check_enum(value: Any) -> None:
+            if value not in options or (
+                (strict_options or isinstance(value, strict))
+                and not any(_json_equal(value, option) for option in options)
+            ):
+                raise SchemaViolation(f"expected one of {options}.")
+
+        checks.append(check_enum)
+    if "const" in schema:
+        const = schema["const"]
+
+        def check_const(value: Any) -> None:
+            if not _json_equal(value, const):
+                raise SchemaViolation(f"expected {const!r}.")
+
+        checks.append(check_const)
+    for compile_keywords, types in KEYWORD_COMPILERS:
+        typed = single_type in types
+        check = compile_keywords(schema, typed)
+        if check is None:
+            continue
+        if typed:
+            # report wrong types before other violations
+            checks.insert(0, check)
+        else:
+            checks.append(check)
+
+    if not checks:
+        return lambda value: None
+    if len(checks) == 1:
+        return checks[0]
+    if len(checks) == 2:
+        first, second = checks
+
+        def check_both(value: Any) -> None:
+            first(value)
+            second(value)
+
+        return check_both
+
+    def check_all(value: Any) -> None:
+        for check in checks:
+            check(value)
+
+    return check_all
+
+
+class SchemaCache:
+    """Compiled validators of the `schema.json` files of the studies.
+
+    A study's schema file is checked for changes at most every
+    `poll_interval` seconds by comparing its mtime and size, and only
+    recompiled when it changed. An invalid schema is reported and the
+    previously compiled schema stays in use. At most `max_entries` studies are
+    remembered.
+    """
+
+    def __init__(
+        self,
+        poll_interval: float = SCHEMA_POLL_INTERVAL,
+        max_entries: int = MAX_SCHEMA_ENTRIES,
+    ):
+        self.poll_interval = poll_interval
+        self.max_entries = max_entries
+        # study -> (next check, file id, validator)
+        self._entries: OrderedDict[
+            str, Tuple[float, Optional[Tuple[int, int]], Optional[Validator]]
+        ] = OrderedDict()
+
+    def get(self, studies_dir: Path, study: str) -> Optional[Validator]:
+        """The validator of `study`, or None if it has no schema."""
+        now = time.monotonic()
+        entry = self._entries.get(study)
+        if entry is not None:
+            self._entries.move_to_end(study)
+            if now < entry[0]:
+                return entry[2]
+
+        schema_path = studies_dir / study / SCHEMA_FILE_NAME
+        try:
+            if not schema_path.resolve().is_relative_to(studies_dir.resolve()):
+                return None
+            stat = schema_path.stat()
+        except OSError:
+            self._store(study, (now + self.poll_interval, None, None))
+            return None
+
+        file_id = (stat.st_mtime_ns, stat.st_size)
+        validator = None if entry is None else entry[2]
+        if entry is None or entry[1] != file_id:
+            try:
+                with open(schema_path, "rb") as f_schema:
+                    validator = compile_schema(json.load(f_schema))
+            except (OSError, TypeError, ValueError, re.error) as error:
+                print(f"ERROR: invalid {schema_path}, keeping old schema: {error}")
+        self._store(study, (now + self.poll_interval, file_id, validator))
+        return validator
+
+    def _store(
+        self,
+        study: str,
+        entry: Tuple[float, Optional[Tuple[int, int]], Optional[Validator]],
+    ) -> None:
+        self._entries[study] = entry
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
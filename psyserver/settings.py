@@ -1,11 +1,16 @@
+import time
 import tomllib
-from functools import lru_cache
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
-from pydantic_settings import BaseSettings
+from pydantic import Field, ValidationError, model_validator
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 DEFAULT_CONFIG_NAME = "psyserver.toml"
 DEFAULT_DB_PATH = "counter.db"
+# seconds between checks whether the config file changed
+SETTINGS_POLL_INTERVAL = 1.0
 
 
 class Settings(BaseSettings):
@@ -14,6 +19,75 @@ class Settings(BaseSettings):
     redirect_url: str | None = None
     h_captcha_verify_url: str = "https://api.hcaptcha.com/siteverify"
     h_captcha_secret: str | None = None
+    idempotency_ttl: float = 86400
+    idempotency_max_entries: int = 10000
+    rate_limit_client: float | None = Field(default=None, gt=0)
+    rate_limit_client_burst: float = Field(default=20, ge=1)
+    rate_limit_study: float | None = Field(default=None, gt=0)
+    rate_limit_study_burst: float = Field(default=200, ge=1)
+    max_concurrent_writes: int | None = Field(default=None, ge=1)
+    max_write_queue: int = Field(default=100, ge=0)
+    write_queue_timeout: float = Field(default=10, gt=0)
+    trace_log: str | None = None
+    profile_slowest: int = 0
+    profile_dir: str = "profiles"
+    profile_interval: float = 0.005
+    storage: Literal["filesystem", "sqlite", "s3"] = "filesystem"
+    sqlite_storage_path: str = "studydata.db"
+    s3_endpoint_url: str | None = None
+    s3_bucket: str | None = None
+    s3_access_key: str | None = None
+    s3_secret_key: str | None = None
+    s3_region: str = "us-east-1"
+    s3_prefix: str = ""
+    # S3 rejects smaller parts, except for the last one
+    s3_part_size: int = Field(default=8 * 1024 * 1024, ge=5 * 1024 * 1024)
+    s3_max_connections: int = 8
+    spool_dir: str = "spool"
+    media_steps: List[Literal["checksum", "info", "trim_silence", "resample"]] = []
+    media_sample_rate: int = 16000
+    media_silence_threshold: int = 500
+    media_workers: int = 2
+    media_jobs_db: str = "media_jobs.db"
+    quota_soft_bytes: int | None = None
+    quota_hard_bytes: int | None = None
+    schema_mode: Literal["reject", "flag"] = "reject"
+    studies: Dict[str, Dict[str, Any]] = {}
+
+    model_config = SettingsConfigDict(frozen=True)
+
+    @model_validator(mode="after")
+    def check_quotas_supported(self) -> "Settings":
+        # usage of data already in the object store is unknown after a restart
+        quotas = (self.quota_soft_bytes, self.quota_hard_bytes)
+        if self.storage == "s3" and any(quota is not None for quota in quotas):
+            raise ValueError("quotas are not supported with storage 's3'.")
+        return self
+
+
+# settings fixed at startup or applying to the whole server, which can not be
+# overridden per study
+SERVER_SETTINGS = frozenset(
+    {
+        "studies_dir",
+        "data_dir",
+        "max_concurrent_writes",
+        "max_write_queue",
+        "write_queue_timeout",
+        "idempotency_ttl",
+        "idempotency_max_entries",
+        "trace_log",
+        "profile_slowest",
+        "profile_dir",
+        "profile_interval",
+        "storage",
+        "sqlite_storage_path",
+        "spool_dir",
+        "media_workers",
+        "media_jobs_db",
+        *(name for name in Settings.model_fields if name.startswith("s3_")),
+    }
+)
 
 
 def default_config_path() -> Path:
@@ -24,12 +98,96 @@ def default_db_path() -> Path:
     return Path.cwd() / DEFAULT_DB_PATH
 
 
-@lru_cache()
-def get_settings_toml():
-    """Returns the settings from the given config."""
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    """Validated settings of one version of the config file."""
+
+    settings: Settings
+    # settings with the `[psyserver.studies.<study>]` overrides applied
+    studies: Dict[str, Settings]
+    file_id: Tuple[int, int]
+
 
+def load_settings_snapshot() -> SettingsSnapshot:
+    """Read and validate the config file, resolving all per-study overrides."""
     config_path = default_config_path()
+    stat = config_path.stat()
     with open(config_path, "rb") as configfile:
         config = tomllib.load(configfile)
 
-    return Settings(**config["psyserver"])
+    settings = Settings(**config["psyserver"])
+    base = settings.model_dump(exclude={"studies"})
+    studies = {}
+    for study, overrides in settings.studies.items():
+        if "studies" in overrides:
+            raise ValueError(f"studies.{study}: nested 'studies' not allowed.")
+        server_wide = sorted(SERVER_SETTINGS.intersection(overrides))
+        if server_wide:
+            raise ValueError(
+                f"studies.{study}: server-wide settings not allowed: {server_wide}."
+            )
+        studies[study] = Settings(**{**base, **overrides})
+    return SettingsSnapshot(settings, studies, (stat.st_mtime_ns, stat.st_size))
+
+
+class SettingsStore:
+    """Holds the current settings and reloads them when the config changes.
+
+    The config file is checked at most every `poll_interval` seconds by
+    comparing its mtime and size. A changed file is validated completely before
+    the snapshot is swapped; an invalid file is reported and the previous
+    settings stay in use.
+    """
+
+    def __init__(self, poll_interval: float = SETTINGS_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._snapshot: Optional[SettingsSnapshot] = None
+        self._next_check = 0.0
+
+    def snapshot(self) -> SettingsSnapshot:
+        now = time.monotonic()
+        if self._snapshot is None:
+            self._snapshot = load_settings_snapshot()
+            self._next_check = now + self.poll_interval
+        elif now >= self._next_check:
+            self._next_check = now + self.poll_interval
+            self._check_reload()
+        return self._snapshot
+
+    def _check_reload(self) -> None:
+        try:
+            stat = default_config_path().stat()
+        except OSError:
+            return
+        if (stat.st_mtime_ns, stat.st_size) == self._snapshot.file_id:
+            return
+        try:
+            self._snapshot = load_settings_snapshot()
+        except (OSError, KeyError, ValueError, ValidationError) as error:
+            print(
+                f"ERROR: invalid {DEFAULT_CONFIG_NAME}, keeping old settings: {error}"
+            )
+        else:
+            print(f"INFO: reloaded {DEFAULT_CONFIG_NAME}.")
+
+    def reset(self) -> None:
+        """Forget the current settings, they are reloaded on next access."""
+        self._snapshot = None
+
+
+settings_store = SettingsStore()
+
+
+def get_settings_toml() -> Settings:
+    """Returns the current settings from the config."""
+    return settings_store.snapshot().settings
+
+
+def get_study_settings(study: str) -> Settings:
+    """Returns the current settings with the overrides of `study` applied."""
+    snapshot = settings_store.snapshot()
+    return snapshot.studies.get(study, snapshot.settings)
+
+
+def reset_settings() -> None:
+    settings_store.reset()
@@ -0,0 +1,410 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+
+from psyserver.archive import read_submission
+from psyserver.settings import Settings
+
+STORAGE_BACKENDS = ("filesystem", "sqlite", "s3")
+
+
+class StorageBackend(ABC):
+    """Destination of submitted study data.
+
+    Data is addressed by a key relative to the data directory, e.g.
+    `exp_cute/screening/debug_1_2023-11-02_01-49-39.json`.
+    """
+
+    @abstractmethod
+    def write(self, base_path: Path, key: str, data: str | bytes) -> Optional[int]:
+        """Store `data` under `key`, replacing earlier data.
+
+        Returns the size in bytes of the replaced data, None for a new key.
+        """
+
+    @abstractmethod
+    def read(self, base_path: Path, key: str) -> bytes:
+        """Return the data stored under `key`."""
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class FileStorage(StorageBackend):
+    """Stores every submission as file below the data directory (default)."""
+
+    def write(self, base_path: Path, key: str, data: str | bytes) -> Optional[int]:
+        path = base_path / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = None
+        mode = "wb" if isinstance(data, bytes) else "w"
+        with open(path, mode) as f_out:
+            f_out.write(data)
+        return replaced
+
+    def read(self, base_path: Path, key: str) -> bytes:
+        # compacted submissions are read from their day archive
+        return read_submission(base_path / key)
+
+
+class SQLiteStorage(StorageBackend):
+    """Stores submissions as blobs in a single SQLite file.
+
+    Suited for studies producing many tiny records, which would otherwise each
+    take up a file.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                key TEXT PRIMARY KEY,
+                data BLOB,
+                created TEXT
+            );"""
+        )
+        self.conn.commit()
+
+    def write(self, base_path: Path, key: str, data: str | bytes) -> Optional[int]:
+        if isinstance(data, str):
+            data = data.encode()
+        item = self.conn.execute(
+            "SELECT length(data) FROM blobs WHERE key=?", (key,)
+        ).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO blobs (key, data, created) VALUES (?, ?, ?)",
+            (key, data, datetime.now().isoformat()),
+        )
+        self.conn.commit()
+        return None if item is None else item[0]
+
+    def read(self, base_path: Path, key: str) -> bytes:
+        item = self.conn.execute(
+            "SELECT data FROM blobs WHERE key=?", (key,)
+        ).fetchone()
+        if item is None:
+            raise FileNotFoundError(key)
+        return item[0]
+
+    def keys(self, prefix: str = "") -> List[str]:
+        res = self.conn.execute(
+            "SELECT key FROM blobs WHERE key >= ? AND key < ? ORDER BY key",
+            (prefix, prefix + "\U0010ffff"),
+        )
+        return [item[0] for item in res.fetchall()]
+
+    def sizes(self) -> List[Tuple[str, int]]:
+        """Keys and sizes in bytes of all stored blobs."""
+        # own connection, this may run in another thread than the writes
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute("SELECT key, length(data) FROM blobs").fetchall()
+        finally:
+            conn.close()
+
+    async def stop(self) -> None:
+        self.conn.close()
+
+
+def _sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_id(stat: os.stat_result) -> Tuple[int, int, int]:
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _hmac_sha256(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+class S3Storage(StorageBackend):
+    """Stores submissions in an S3-compatible object store.
+
+    Submissions are first written to a local spool directory, so participant
+    requests never wait on the object store. Background workers upload spooled
+    files with a pooled http client, using concurrent multipart uploads for
+    files larger than `part_size`, and remove them from the spool once stored.
+    Failed uploads are retried; files left in the spool are uploaded after a
+    restart.
+    """
+
+    def __init__(
+        self,
+        endpoint_url: str,
+        bucket: str,
+        access_key: str,
+        secret_key: str,
+        region: str = "us-east-1",
+        prefix: str = "",
+        spool_dir: Path | str = "spool",
+        part_size: int = 8 * 1024 * 1024,
+        max_connections: int = 8,
+        retry_delay: float = 5.0,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.endpoint_url = endpoint_url.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self.spool_dir = Path(spool_dir)
+        self.part_size = part_size
+        self.max_connections = max_connections
+        self.retry_delay = retry_delay
+        self.transport = transport
+        self.client: Optional[httpx.AsyncClient] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._uploading: Dict[str, asyncio.Future] = {}
+
+    def write(self, base_path: Path, key: str, data: str | bytes) -> Optional[int]:
+        if isinstance(data, str):
+            data = data.encode()
+        # start before spooling, so the new file is not queued twice
+        self._ensure_started()
+        spool_path = self.spool_dir / key
+        spool_path.parent.mkdir(parents=True, exist_ok=True)
+        # write under a temporary name, so only complete files get uploaded
+        tmp_path = spool_path.with_name(f".{spool_path.name}.tmp")
+        with open(tmp_path, "wb") as f_out:
+            f_out.write(data)
+        os.replace(tmp_path, spool_path)
+        self.queue.put_nowait(key)
+        # the object store is not asked, quotas are not supported with it
+        return None
+
+    def read(self, base_path: Path, key: str) -> bytes:
+        spool_path = self.spool_dir / key
+        if spool_path.exists():
+            with open(spool_path, "rb") as f_in:
+                return f_in.read()
+        raise FileNotFoundError(f"{key} is only available in the object store.")
+
+    async def start(self) -> None:
+        self._ensure_started()
+
+    def _ensure_started(self) -> None:
+        if self._workers:
+            return
+        self.client = httpx.AsyncClient(
+            transport=self.transport,
+            limits=httpx.Limits(max_connections=self.max_connections),
+            timeout=httpx.Timeout(60),
+        )
+        self.queue = asyncio.Queue()
+        # resume uploads interrupted by a restart
+        for spooled in self.pending():
+            self.queue.put_nowait(spooled)
+        self._workers = [
+            asyncio.get_running_loop().create_task(self._worker())
+            for _ in range(self.max_connections)
+        ]
+
+    def pending(self) -> List[str]:
+        """Keys of spooled files not uploaded yet."""
+        if not self.spool_dir.exists():
+            return []
+        return sorted(
+            path.relative_to(self.spool_dir).as_posix()
+            for path in self.spool_dir.rglob("*")
+            if path.is_file() and not path.name.endswith(".tmp")
+        )
+
+    async def drain(self) -> None:
+        """Wait until all queued files are uploaded."""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self.queue.get()
+            try:
+                await self._upload(key)
+            except Exception as error:
+                print(f"ERROR: upload of {key} failed, retrying: {error}")
+                asyncio.get_running_loop().call_later(
+                    self.retry_delay, self.queue.put_nowait, key
+                )
+            finally:
+                self.queue.task_done()
+
+    async def _upload(self, key: str) -> None:
+        # one upload per key at a time, so the last written version is stored
+        while key in self._uploading:
+            await asyncio.shield(self._uploading[key])
+        self._uploading[key] = asyncio.get_running_loop().create_future()
+        try:
+            await self._upload_spooled(key)
+        finally:
+            self._uploading.pop(key).set_result(None)
+
+    async def _upload_spooled(self, key: str) -> None:
+        spool_path = self.spool_dir / key
+        try:
+            f_in = open(spool_path, "rb")
+        except FileNotFoundError:
+            # already uploaded by a retry
+            return
+        with f_in:
+            snapshot = _file_id(os.fstat(f_in.fileno()))
+            data = f_in.read()
+
+        object_key = f"{self.prefix}{key}"
+        if len(data) <= self.part_size:
+            response = await self._request("PUT", object_key, data=data)
+            response.raise_for_status()
+        else:
+            await self._upload_multipart(object_key, data)
+        # the key may have been written again meanwhile, that version is queued
+        try:
+            if _file_id(spool_path.stat()) == snapshot:
+                spool_path.unlink()
+        except FileNotFoundError:
+            pass
+
+    async def _upload_multipart(self, object_key: str, data: bytes) -> None:
+        response = await self._request("POST", object_key, params={"uploads": ""})
+        response.raise_for_status()
+        match = re.search(r"<UploadId>(.+?)</UploadId>", response.text)
+        if match is None:
+            raise httpx.HTTPError(f"no UploadId in response for {object_key}")
+        upload_id = match.group(1)
+
+        async def upload_part(number: int, offset: int) -> str:
+            part = await self._request(
+                "PUT",
+                object_key,
+                params={"partNumber": str(number), "uploadId": upload_id},
+                data=data[offset : offset + self.part_size],
+            )
+            part.raise_for_status()
+            return part.headers["ETag"]
+
+        try:
+            offsets = range(0, len(data), self.part_size)
+            etags = await asyncio.gather(
+                *(
+                    upload_part(number, offset)
+                    for number, offset in enumerate(offsets, start=1)
+                )
+            )
+            parts = "".join(
+                f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+                for number, etag in enumerate(etags, start=1)
+            )
+            body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>"
+            response = await self._request(
+                "POST", object_key, params={"uploadId": upload_id}, data=body.encode()
+            )
+            response.raise_for_status()
+        except httpx.HTTPError:
+            await self._request("DELETE", object_key, params={"uploadId": upload_id})
+            raise
+
+    async def _request(
+        self,
+        method: str,
+        object_key: str,
+        params: Optional[Dict[str, str]] = None,
+        data: bytes = b"",
+    ) -> httpx.Response:
+        path = f"/{self.bucket}/{quote(object_key, safe='/~')}"
+        query = "&".join(
+            f"{quote(name, safe='~')}={quote(value, safe='~')}"
+            for name, value in sorted((params or {}).items())
+        )
+        headers = self._sign(method, path, query, data)
+        url = f"{self.endpoint_url}{path}" + (f"?{query}" if query else "")
+        return await self.client.request(method, url, headers=headers, content=data)
+
+    def _sign(self, method: str, path: str, query: str, data: bytes) -> Dict[str, str]:
+        """AWS signature version 4 headers for a request."""
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = now.strftime("%Y%m%d")
+        host = httpx.URL(self.endpoint_url).netloc.decode()
+        payload_hash = _sha256_hex(data)
+
+        canonical_headers = (
+            f"host:{host}\nx-amz-content-sha256:{payload_hash}\nx-amz-date:{amz_date}\n"
+        )
+        signed_headers = "host;x-amz-content-sha256;x-amz-date"
+        canonical_request = "\n".join(
+            [method, path, query, canonical_headers, signed_headers, payload_hash]
+        )
+        scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                _sha256_hex(canonical_request.encode()),
+            ]
+        )
+        key = _hmac_sha256(f"AWS4{self.secret_key}".encode(), datestamp)
+        for part in (self.region, "s3", "aws4_request"):
+            key = _hmac_sha256(key, part)
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return {
+            "x-amz-date": amz_date,
+            "x-amz-content-sha256": payload_hash,
+            "Authorization": (
+                f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                f"SignedHeaders={signed_headers}, Signature={signature}"
+            ),
+        }
+
+
+def create_storage(settings: Settings) -> StorageBackend:
+    """Create the storage backend configured by `storage`."""
+    if settings.storage == "filesystem":
+        return FileStorage()
+    if settings.storage == "sqlite":
+        return SQLiteStorage(settings.sqlite_storage_path)
+    if settings.storage == "s3":
+        if settings.s3_endpoint_url is None or settings.s3_bucket is None:
+            raise ValueError("storage 's3' requires s3_endpoint_url and s3_bucket.")
+        return S3Storage(
+            endpoint_url=settings.s3_endpoint_url,
+            bucket=settings.s3_bucket,
+            access_key=settings.s3_access_key or "",
+            secret_key=settings.s3_secret_key or "",
+            region=settings.s3_region,
+            prefix=settings.s3_prefix,
+            spool_dir=settings.spool_dir,
+            part_size=settings.s3_part_size,
+            max_connections=settings.s3_max_connections,
+        )
+    raise ValueError(
+        f"Unknown storage '{settings.storage}', use one of {STORAGE_BACKENDS}."
+    )
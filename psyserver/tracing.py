@@ -0,0 +1,220 @@
+import heapq
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from psyserver.settings import get_settings_toml
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar(
+    "psyserver_trace", default=None
+)
+
+
+class Trace:
+    """Durations of the phases of a single request."""
+
+    __slots__ = ("start", "spans")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+
+    def add(self, name: str, duration: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def server_timing(self, total: float) -> str:
+        entries = [f"{name};dur={dur * 1000:.3f}" for name, dur in self.spans.items()]
+        entries.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(entries)
+
+
+@contextmanager
+def span(name: str):
+    """Time the enclosed block as phase `name` of the current request."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+def trace_add(name: str, duration: float) -> None:
+    """Add an already measured duration to phase `name` of the current request."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, duration)
+
+
+def mark_since_start(name: str) -> None:
+    """Record the time since the request started as phase `name`.
+
+    Used for work done by the framework before a route is called, such as
+    reading and validating the request body. Phases recorded so far, such as
+    waiting for a write slot, are not counted again.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        elapsed = time.perf_counter() - trace.start
+        trace.add(name, max(0.0, elapsed - sum(trace.spans.values())))
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads to profile the slowest requests.
+
+    A background thread records the stack of every thread each `interval`
+    seconds into a ring buffer. When a request is among the `n_slowest` seen so
+    far, the samples taken while it was in flight are written to `profile_dir`
+    in the collapsed stack format understood by flamegraph tools. Requests
+    handled concurrently share their samples.
+    """
+
+    def __init__(
+        self,
+        n_slowest: int,
+        profile_dir: Path,
+        interval: float = 0.005,
+        history: float = 60,
+    ):
+        self.n_slowest = n_slowest
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.samples: Deque[Tuple[float, str]] = deque(maxlen=int(history / interval))
+        self._slowest: List[Tuple[float, str]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample, name="psyserver-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def _sample(self) -> None:
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+                    )
+                    frame = frame.f_back
+                self.samples.append((now, ";".join(reversed(stack))))
+
+    def finish_request(self, label: str, start: float, end: float) -> None:
+        duration = end - start
+        if len(self._slowest) >= self.n_slowest and duration <= self._slowest[0][0]:
+            return
+
+        counts: Dict[str, int] = {}
+        for timestamp, stack in list(self.samples):
+            if start <= timestamp <= end:
+                counts[stack] = counts.get(stack, 0) + 1
+
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        safe_label = "".join(c if c.isalnum() else "_" for c in label).strip("_")
+        filepath = (
+            self.profile_dir / f"{timestamp}_{safe_label}_{duration * 1000:.0f}ms.txt"
+        )
+        with open(filepath, "w") as f_out:
+            for stack, count in counts.items():
+                f_out.write(f"{stack} {count}\n")
+
+        heapq.heappush(self._slowest, (duration, str(filepath)))
+        if len(self._slowest) > self.n_slowest:
+            _, evicted = heapq.heappop(self._slowest)
+            Path(evicted).unlink(missing_ok=True)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class TraceMiddleware:
+    """ASGI middleware timing the phases of each request.
+
+    The phases are returned in a `Server-Timing` header and, if `trace_log` is
+    configured, appended as json line to that file. With `profile_slowest`
+    configured, stack profiles of the slowest requests are kept in
+    `profile_dir`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._log_path: Optional[str] = None
+        self._log_file = None
+        self.profiler: Optional[SamplingProfiler] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace = Trace()
+        token = _current_trace.set(trace)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = time.perf_counter() - trace.start
+                headers = list(message.get("headers", []))
+                headers.append(
+                    (b"server-timing", trace.server_timing(total).encode("latin-1"))
+                )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_trace.reset(token)
+            end = time.perf_counter()
+            self._finish(scope, trace, status, end)
+
+    def _finish(self, scope, trace: Trace, status: int, end: float) -> None:
+        settings = get_settings_toml()
+        if settings.trace_log is not None:
+            record = {
+                "time": datetime.now().isoformat(),
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status,
+                "total_ms": (end - trace.start) * 1000,
+                "spans_ms": {name: dur * 1000 for name, dur in trace.spans.items()},
+            }
+            self._log(settings.trace_log, json.dumps(record))
+
+        if settings.profile_slowest > 0:
+            if self.profiler is None:
+                self.profiler = SamplingProfiler(
+                    settings.profile_slowest,
+                    Path(settings.profile_dir),
+                    settings.profile_interval,
+                )
+            self.profiler.n_slowest = settings.profile_slowest
+            label = f"{scope['method']} {scope['path']}"
+            self.profiler.finish_request(label, trace.start, end)
+        elif self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def _log(self, path: str, line: str) -> None:
+        if path != self._log_path:
+            if self._log_file is not None:
+                self._log_file.close()
+            self._log_file = open(path, "a", buffering=1)
+            self._log_path = path
+        self._log_file.write(line + "\n")
@@ -0,0 +1,210 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from psyserver.settings import Settings
+from psyserver.storage import FileStorage, SQLiteStorage, StorageBackend
+
+# directories directly below a study which do not belong to a session
+NON_SESSION_DIRS = ("audio", "_archive")
+
+
+def _scan_dir(path: Path) -> Tuple[int, int]:
+    """Total size in bytes and number of files below `path`."""
+    n_bytes = 0
+    n_files = 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(Path(entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    n_bytes += entry.stat(follow_symlinks=False).st_size
+                    n_files += 1
+    return n_bytes, n_files
+
+
+def _scan_study(study_dir: Path) -> Dict[str, List[int]]:
+    sessions: Dict[str, List[int]] = {}
+    with os.scandir(study_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                session = "" if entry.name in NON_SESSION_DIRS else entry.name
+                n_bytes, n_files = _scan_dir(Path(entry.path))
+            elif entry.is_file(follow_symlinks=False):
+                session = ""
+                n_bytes, n_files = entry.stat(follow_symlinks=False).st_size, 1
+            else:
+                continue
+            counts = sessions.setdefault(session, [0, 0])
+            counts[0] += n_bytes
+            counts[1] += n_files
+    return sessions
+
+
+class DiskUsage:
+    """Running byte and file counts of the saved data per study and session.
+
+    The counts are seeded once by scanning `data_dir` and then updated by every
+    save, so checking a quota never touches the disk. Files written while the
+    scan runs may be counted twice, and changes made outside the server, such
+    as `psyserver compact`, are only picked up by the next scan.
+    """
+
+    def __init__(self):
+        # study -> session -> [bytes, files]; "" is data outside a session
+        self.sessions: Dict[str, Dict[str, List[int]]] = {}
+        # study -> [bytes, files]
+        self.studies: Dict[str, List[int]] = {}
+        self.seeded = False
+        self._lock = threading.Lock()
+        self._since_scan: Optional[List[Tuple[str, str, int, int]]] = None
+
+    def add(
+        self,
+        study: str,
+        session: Optional[str],
+        n_bytes: int,
+        replaced: Optional[int] = None,
+    ) -> None:
+        """Count a file of `n_bytes` saved for `study` and `session`.
+
+        `replaced` is the size of the file it replaced, None for a new file.
+        """
+        # nested session dirs are counted for their top directory, like in scans
+        session = Path(session).parts[0] if session else ""
+        if replaced is None:
+            n_files = 1
+        else:
+            n_bytes, n_files = n_bytes - replaced, 0
+        with self._lock:
+            self._add(study, session, n_bytes, n_files)
+            if self._since_scan is not None:
+                self._since_scan.append((study, session, n_bytes, n_files))
+
+    def _add(self, study: str, session: str, n_bytes: int, n_files: int) -> None:
+        totals = self.studies.get(study)
+        if totals is None:
+            totals = self.studies[study] = [0, 0]
+            self.sessions[study] = {}
+        totals[0] += n_bytes
+        totals[1] += n_files
+        counts = self.sessions[study].setdefault(session, [0, 0])
+        counts[0] += n_bytes
+        counts[1] += n_files
+
+    def study_bytes(self, study: str) -> int:
+        totals = self.studies.get(study)
+        return 0 if totals is None else totals[0]
+
+    def seed(self, data_dir: Path | str, workers: Optional[int] = None) -> None:
+        """Replace the counts with a scan of `data_dir`, one study per thread.
+
+        Saves counted while the scan runs are added on top of its results.
+        """
+        data_dir = Path(data_dir)
+
+        def scan() -> Dict[str, Dict[str, List[int]]]:
+            if not data_dir.exists():
+                return {}
+            study_dirs = [path for path in data_dir.iterdir() if path.is_dir()]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                scanned = executor.map(_scan_study, study_dirs)
+                return {
+                    study_dir.name: sessions
+                    for study_dir, sessions in zip(study_dirs, scanned)
+                }
+
+        self._seed(scan)
+
+    def seed_sizes(self, sizes: Iterable[Tuple[str, int]]) -> None:
+        """Replace the counts with the sizes of the stored keys.
+
+        Keys are paths relative to `data_dir`, as used by the storage backends.
+        """
+
+        def scan() -> Dict[str, Dict[str, List[int]]]:
+            studies: Dict[str, Dict[str, List[int]]] = {}
+            for key, size in sizes:
+                parts = key.split("/")
+                session = ""
+                if len(parts) > 2 and parts[1] not in NON_SESSION_DIRS:
+                    session = parts[1]
+                counts = studies.setdefault(parts[0], {}).setdefault(session, [0, 0])
+                counts[0] += size
+                counts[1] += 1
+            return studies
+
+        self._seed(scan)
+
+    def _seed(self, scan: Callable[[], Dict[str, Dict[str, List[int]]]]) -> None:
+        with self._lock:
+            self._since_scan = []
+        try:
+            scanned = scan()
+        except BaseException:
+            with self._lock:
+                self._since_scan = None
+            raise
+
+        with self._lock:
+            self.sessions = {}
+            self.studies = {}
+            for study, sessions in scanned.items():
+                for session, (n_bytes, n_files) in sessions.items():
+                    self._add(study, session, n_bytes, n_files)
+            for study, session, n_bytes, n_files in self._since_scan:
+                self._add(study, session, n_bytes, n_files)
+            self._since_scan = None
+            self.seeded = True
+
+    def report(self) -> Dict[str, Dict]:
+        """Counts per study, with a breakdown per session."""
+        with self._lock:
+            return {
+                study: {
+                    "bytes": totals[0],
+                    "files": totals[1],
+                    "sessions": {
+                        session: {"bytes": counts[0], "files": counts[1]}
+                        for session, counts in sorted(self.sessions[study].items())
+                    },
+                }
+                for study, totals in sorted(self.studies.items())
+            }
+
+
+USAGE = DiskUsage()
+
+
+def seed_usage(usage: DiskUsage, storage: StorageBackend, data_dir: str) -> None:
+    """Seed `usage` with the data already stored by `storage`."""
+    if isinstance(storage, SQLiteStorage):
+        usage.seed_sizes(storage.sizes())
+    elif isinstance(storage, FileStorage):
+        usage.seed(data_dir)
+    else:
+        raise ValueError(f"disk usage of {type(storage).__name__} is unknown.")
+
+
+def check_quota(
+    usage: DiskUsage, study: str, n_bytes: int, settings: Settings
+) -> Optional[str]:
+    """Check whether saving `n_bytes` more keeps `study` within its quotas.
+
+    Raises a 507 error if the hard quota would be exceeded and returns a
+    warning if the soft quota is exceeded.
+    """
+    if settings.quota_hard_bytes is None and settings.quota_soft_bytes is None:
+        return None
+    total = usage.study_bytes(study) + n_bytes
+    if settings.quota_hard_bytes is not None and total > settings.quota_hard_bytes:
+        raise HTTPException(status_code=507, detail="Storage quota of study exceeded.")
+    if settings.quota_soft_bytes is not None and total > settings.quota_soft_bytes:
+        return " storage quota: soft limit exceeded"
+    return None
@@ -1,16 +1,18 @@
+from typing import Callable
+
 import pytest
 from fastapi.testclient import TestClient
 
 from psyserver.init import init_dir
 from psyserver.main import create_app
-from psyserver.settings import get_settings_toml
+from psyserver.settings import reset_settings
 
 
 @pytest.fixture(autouse=True)
 def change_test_dir(tmp_path, monkeypatch):
     monkeypatch.chdir(tmp_path)
     init_dir(no_filebrowser=True)
-    get_settings_toml.cache_clear()
+    reset_settings()
 
 
 @pytest.fixture()
@@ -21,3 +23,20 @@ def app(change_test_dir):
 @pytest.fixture()
 def client(change_test_dir, app):
     return TestClient(app)
+
+
+@pytest.fixture()
+def configure(change_test_dir) -> Callable[[str], TestClient]:
+    """Add config lines to the [psyserver] table; returns a client of a new app."""
+
+    def configure(config: str) -> TestClient:
+        with open("psyserver.toml", "r") as f_config:
+            original = f_config.read()
+        with open("psyserver.toml", "w") as f_config:
+            f_config.write(
+                original.replace("[psyserver]\n", f"[psyserver]\n{config}\n")
+            )
+        reset_settings()
+        return TestClient(create_app())
+
+    return configure
@@ -0,0 +1,76 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from psyserver.archive import (
+    ARCHIVE_DIR_NAME,
+    compact_study,
+    iter_submissions,
+    load_archive_index,
+    read_submission,
+)
+from psyserver.storage import FileStorage
+
+STUDY_DIR = Path("data/studydata/exp_cute")
+
+
+def _write_submission(path: Path, data: dict, age_days: float) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f_out:
+        json.dump(data, f_out)
+    mtime = time.time() - age_days * 86400
+    os.utime(path, (mtime, mtime))
+
+
+def test_compact_old_submissions():
+    old_1 = STUDY_DIR / "debug_1_2023-11-02_01-49-39.json"
+    old_2 = STUDY_DIR / "screening" / "debug_2_2023-11-02_01-50-00.json"
+    new = STUDY_DIR / "debug_3_2023-11-30_10-00-00.json"
+    _write_submission(old_1, {"participantID": "debug_1"}, age_days=40)
+    _write_submission(old_2, {"participantID": "debug_2"}, age_days=40)
+    _write_submission(new, {"participantID": "debug_3"}, age_days=1)
+
+    assert compact_study("exp_cute", older_than_days=30) == 0
+
+    assert not old_1.exists()
+    assert not old_2.exists()
+    assert new.exists()
+    assert (STUDY_DIR / ARCHIVE_DIR_NAME).is_dir()
+    assert old_1.name in load_archive_index(STUDY_DIR)
+    assert old_2.name in load_archive_index(old_2.parent)
+
+    # archived submissions remain readable under their original path
+    assert json.loads(read_submission(old_1)) == {"participantID": "debug_1"}
+    assert json.loads(read_submission(old_2)) == {"participantID": "debug_2"}
+    assert json.loads(read_submission(new)) == {"participantID": "debug_3"}
+
+    found = {path: json.loads(data) for path, data in iter_submissions(STUDY_DIR)}
+    assert set(found) == {old_1, old_2, new}
+
+
+def test_compact_twice_appends_to_archive():
+    first = STUDY_DIR / "debug_1_2023-11-02_01-49-39.json"
+    _write_submission(first, {"participantID": "debug_1"}, age_days=40)
+    assert compact_study("exp_cute", older_than_days=30) == 0
+
+    second = STUDY_DIR / "debug_2_2023-11-02_01-49-40.json"
+    _write_submission(second, {"participantID": "debug_2"}, age_days=40)
+    assert compact_study("exp_cute", older_than_days=30) == 0
+
+    assert set(load_archive_index(STUDY_DIR)) == {first.name, second.name}
+    assert json.loads(read_submission(first)) == {"participantID": "debug_1"}
+
+
+def test_compact_invalid_study():
+    assert compact_study("../../", older_than_days=30) == 1
+    assert compact_study("missing_study", older_than_days=30) == 1
+
+
+def test_file_storage_reads_archived():
+    old = STUDY_DIR / "debug_1_2023-11-02_01-49-39.json"
+    _write_submission(old, {"participantID": "debug_1"}, age_days=40)
+    assert compact_study("exp_cute", older_than_days=30) == 0
+
+    data = FileStorage().read(STUDY_DIR.parent, f"exp_cute/{old.name}")
+    assert json.loads(data) == {"participantID": "debug_1"}
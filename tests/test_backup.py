@@ -0,0 +1,40 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+from psyserver.backup import MANIFEST_NAME, backup, load_latest_snapshot
+from psyserver.db import get_increment_study_count_db
+
+
+def test_backup_full_then_incremental():
+    get_increment_study_count_db("exp_cute")
+    submission = Path("data/studydata/exp_cute/debug_1.json")
+    submission.write_text(json.dumps({"participantID": "debug_1"}))
+
+    assert backup("backups") == 0
+    first, manifest = load_latest_snapshot(Path("backups"))
+    assert first is not None
+    assert "data/studydata/exp_cute/debug_1.json" in manifest
+    assert "data/studies/exp_cute/index.html" in manifest
+    assert (first / MANIFEST_NAME).exists()
+
+    # counter.db is a consistent copy
+    with sqlite3.connect(first / "counter.db") as conn:
+        count = conn.execute("SELECT count FROM studies WHERE study='exp_cute'")
+        assert count.fetchone()[0] == 1
+
+    changed = Path("data/studydata/exp_cute/debug_2.json")
+    changed.write_text(json.dumps({"participantID": "debug_2"}))
+
+    assert backup("backups") == 0
+    second, manifest = load_latest_snapshot(Path("backups"))
+    assert second != first
+    assert "data/studydata/exp_cute/debug_2.json" in manifest
+
+    # unchanged files are hardlinks to the previous snapshot
+    rel = "data/studydata/exp_cute/debug_1.json"
+    assert os.stat(first / rel).st_ino == os.stat(second / rel).st_ino
+    assert (second / "data/studydata/exp_cute/debug_2.json").read_text() == (
+        changed.read_text()
+    )
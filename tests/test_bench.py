@@ -0,0 +1,30 @@
+import json
+from pathlib import Path
+
+from psyserver.bench import percentile, run_bench
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 99) == 3
+
+
+def test_run_bench():
+    cwd = Path.cwd()
+    report = run_bench(
+        participants=4, rounds=2, trial_kb=5, audio_kb=5, output="bench.json"
+    )
+    assert Path.cwd() == cwd
+
+    assert set(report["routes"]) == {"static", "get_count", "save", "save_audio"}
+    for stats in report["routes"].values():
+        assert stats["requests"] == 8
+        assert stats["errors"] == 0
+        assert stats["p50_ms"] <= stats["p95_ms"] <= stats["p99_ms"]
+        assert stats["throughput_rps"] > 0
+
+    with open("bench.json", "r") as f_report:
+        assert json.load(f_report) == json.loads(json.dumps(report))
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+
+from psyserver.admin import create_admin_app
+from psyserver.events import MONITOR, SubmissionMonitor
+
+
+def test_monitor_coalesces_events():
+    async def run():
+        monitor = SubmissionMonitor()
+        stream = monitor.stream(interval=0.01, keepalive=0.02)
+        assert json.loads((await anext(stream))[len("data: ") :]) == {}
+
+        # a burst of events results in a single message
+        for _ in range(100):
+            monitor.emit("exp_cute", "save")
+        monitor.emit("exp_cute", "error")
+        message = await anext(stream)
+        counts = json.loads(message[len("data: ") :])
+        assert counts == {"exp_cute": {"save": 100, "audio": 0, "count": 0, "error": 1}}
+
+        # without changes, only keepalives are sent
+        assert await anext(stream) == ": keepalive\n\n"
+
+    asyncio.run(run())
+
+
+def test_monitor_message_encoded_once():
+    monitor = SubmissionMonitor()
+    monitor.emit("exp_cute", "count")
+    assert monitor.message() is monitor.message()
+
+
+def test_routes_emit_events(client):
+    before = dict(MONITOR.counts.get("exp_cute", {"save": 0, "count": 0, "error": 0}))
+    client.post("/exp_cute/save", json={"participantID": "debug_1"})
+    client.get("/exp_cute/get_count")
+    client.post("/exp_cute/save", json={"session_dir": "../../.."})
+
+    counts = MONITOR.counts["exp_cute"]
+    assert counts["save"] == before["save"] + 1
+    assert counts["count"] == before["count"] + 1
+    assert counts["error"] == before["error"] + 1
+
+
+def test_monitor_page():
+    response = TestClient(create_admin_app()).get("/monitor")
+    assert response.status_code == 200
+    assert "EventSource" in response.text
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from psyserver.limits import TokenBucket, WriteLimiter
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0 < bucket.take() <= 1
+
+
+def test_rate_limit_client(configure):
+    client = configure("rate_limit_client = 0.01\nrate_limit_client_burst = 2")
+    assert client.get("/exp_cute/get_count").status_code == 200
+    assert client.get("/other_study/get_count").status_code == 200
+    response = client.get("/exp_cute/get_count")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+
+def test_rate_limit_study_override(configure):
+    client = configure(
+        "rate_limit_study = 0.01\nrate_limit_study_burst = 1\n"
+        "[psyserver.studies.exp_cute]\nrate_limit_study_burst = 3"
+    )
+    assert client.get("/other_study/get_count").status_code == 200
+    assert client.get("/other_study/get_count").status_code == 429
+    for _ in range(3):
+        assert client.get("/exp_cute/get_count").status_code == 200
+    assert client.get("/exp_cute/get_count").status_code == 429
+
+
+def test_write_limiter_queue_full():
+    async def run():
+        limiter = WriteLimiter(max_concurrent=1)
+        await limiter.acquire(max_queue=1, timeout=0.05)
+        waiter = asyncio.create_task(limiter.acquire(max_queue=1, timeout=0.05))
+        await asyncio.sleep(0)
+        assert limiter.waiting == 1
+        # queue is full
+        with pytest.raises(HTTPException) as exc_info:
+            await limiter.acquire(max_queue=1, timeout=0.05)
+        assert exc_info.value.status_code == 429
+        assert "Retry-After" in exc_info.value.headers
+        # waiting request times out
+        with pytest.raises(HTTPException):
+            await waiter
+        limiter.release()
+        await limiter.acquire(max_queue=1, timeout=0.05)
+        assert limiter.active == 1
+
+    asyncio.run(run())
+
+
+def test_write_limit_allows_sequential_writes(configure):
+    client = configure("max_concurrent_writes = 1")
+    for _ in range(3):
+        response = client.post("/exp_cute/save", json={"participantID": "debug_1"})
+        assert response.status_code == 200
+
+
+def test_rate_limited_upload_not_received(configure):
+    client = configure("rate_limit_study = 0.01\nrate_limit_study_burst = 1")
+    response = client.post(
+        "/exp_cute/save_audio", files={"audio_data": ("rec.wav", b"RIFF", "audio/wav")}
+    )
+    assert response.status_code == 200
+
+    received = []
+    sent = []
+
+    async def receive():
+        received.append(True)
+        return {"type": "http.request", "body": b"x" * 1000, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/exp_cute/save_audio",
+        "raw_path": b"/exp_cute/save_audio",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"multipart/form-data; boundary=x")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("testserver", 80),
+    }
+    asyncio.run(client.app(scope, receive, send))
+    assert sent[0]["status"] == 429
+    assert not received
@@ -1,8 +1,16 @@
+import asyncio
 import json
+import sqlite3
 from pathlib import Path
 from unittest.mock import Mock, mock_open, patch
 
-from psyserver.settings import get_settings_toml
+import httpx
+from fastapi.testclient import TestClient
+from starlette.datastructures import UploadFile
+
+from psyserver import idempotency
+from psyserver.main import create_app
+from psyserver.storage import FileStorage
 
 cute_exp_html_start = """\
 <!DOCTYPE html>
@@ -30,7 +38,7 @@ def test_save_data_json1(client):
     mock_datetime = Mock()
     mock_datetime.now = Mock(return_value="2023-11-02_01:49:39.905657")
     with (
-        patch("psyserver.main.open", mock_open_exp_data, create=False),
+        patch("psyserver.storage.open", mock_open_exp_data, create=False),
         patch("psyserver.main.datetime", mock_datetime),
     ):
         response = client.post("/exp_cute/save", json=example_data)
@@ -63,7 +71,7 @@ def test_save_data_json2(client):
     mock_datetime = Mock()
     mock_datetime.now = Mock(return_value="2023-11-02_01:49:39.905657")
     with (
-        patch("psyserver.main.open", mock_open_exp_data, create=False),
+        patch("psyserver.storage.open", mock_open_exp_data, create=False),
         patch("psyserver.main.datetime", mock_datetime),
     ):
         response = client.post("/exp_cute/save", json=example_data)
@@ -94,7 +102,7 @@ def test_save_data_json3(client):
     mock_datetime = Mock()
     mock_datetime.now = Mock(return_value="2023-11-02_01:49:39.905657")
     with (
-        patch("psyserver.main.open", mock_open_exp_data, create=False),
+        patch("psyserver.storage.open", mock_open_exp_data, create=False),
         patch("psyserver.main.datetime", mock_datetime),
     ):
         response = client.post("/exp_cute/save", json=example_data)
@@ -184,7 +192,7 @@ def test_save_data_json_h_captcha_no_secret_key(client):
 
     # set secret key
     with (
-        patch("psyserver.main.open", mock_open_exp_data, create=False),
+        patch("psyserver.storage.open", mock_open_exp_data, create=False),
         patch("psyserver.main.datetime", mock_datetime),
     ):
         response = client.post("/exp_cute/save", json=example_data)
@@ -203,7 +211,7 @@ def test_save_data_json_h_captcha_no_secret_key(client):
     )
 
 
-def test_save_data_json_h_captcha_verified(client):
+def test_save_data_json_h_captcha_verified(client, configure):
     example_data = {
         "participantID": "debug_1",
         "condition": "1",
@@ -211,13 +219,6 @@ def test_save_data_json_h_captcha_verified(client):
         "h_captcha_response": "valid-response",
     }
 
-    # load config to test its url and use later to replace
-    mock_default_config_path = Mock(
-        return_value=Path.cwd() / "psyserver" / "example" / "psyserver.toml"
-    )
-    with patch("psyserver.settings.default_config_path", mock_default_config_path):
-        settings = get_settings_toml()
-
     # ensure h_captcha verification is replaced with mock
     mock_resp = Mock()
     mock_resp.status_code = 200
@@ -230,12 +231,10 @@ def test_save_data_json_h_captcha_verified(client):
     mock_datetime.now = Mock(return_value="2023-11-02_01:49:39.905657")
 
     # set secret key
-    settings.h_captcha_secret = "secret key!"
-    mock_get_settings = Mock(return_value=settings)
+    configure('h_captcha_secret = "secret key!"')
     with (
-        patch("psyserver.main.open", mock_open_exp_data, create=False),
+        patch("psyserver.storage.open", mock_open_exp_data, create=False),
         patch("psyserver.main.datetime", mock_datetime),
-        patch("psyserver.settings.get_settings_toml", mock_get_settings),
         patch("psyserver.main.requests.post", mock_request_post),
     ):
         response = client.post("/exp_cute/save", json=example_data)
@@ -258,7 +257,7 @@ def test_save_audio_without_session_dir(client):
         return_value=Mock(strftime=Mock(return_value="20231102_014939"))
     )
     with (
-        patch("psyserver.main.open", mock_open_audio, create=False),
+        patch("psyserver.storage.open", mock_open_audio, create=False),
         patch("psyserver.main.datetime", mock_datetime),
     ):
         response = client.post(
@@ -288,7 +287,7 @@ def test_save_audio_with_session_dir(client):
         return_value=Mock(strftime=Mock(return_value="20231102_014939"))
     )
     with (
-        patch("psyserver.main.open", mock_open_audio, create=False),
+        patch("psyserver.storage.open", mock_open_audio, create=False),
         patch("psyserver.main.datetime", mock_datetime),
     ):
         response = client.post(
@@ -312,7 +311,7 @@ def test_save_audio_with_session_dir(client):
     )
 
 
-def test_save_data_json_h_captcha_failed_response(client):
+def test_save_data_json_h_captcha_failed_response(client, configure):
     example_data = {
         "participantID": "debug_1",
         "condition": "1",
@@ -320,13 +319,6 @@ def test_save_data_json_h_captcha_failed_response(client):
         "h_captcha_response": "valid-response",
     }
 
-    # load config to test its url and use later to replace
-    mock_default_config_path = Mock(
-        return_value=Path.cwd() / "psyserver" / "example" / "psyserver.toml"
-    )
-    with patch("psyserver.settings.default_config_path", mock_default_config_path):
-        settings = get_settings_toml()
-
     # ensure h_captcha verification is replaced with mock
     mock_resp = Mock()
     mock_resp.status_code = 403
@@ -339,12 +331,10 @@ def test_save_data_json_h_captcha_failed_response(client):
     mock_datetime.now = Mock(return_value="2023-11-02_01:49:39.905657")
 
     # set secret key
-    settings.h_captcha_secret = "secret key!"
-    mock_get_settings = Mock(return_value=settings)
+    configure('h_captcha_secret = "secret key!"')
     with (
-        patch("psyserver.main.open", mock_open_exp_data, create=False),
+        patch("psyserver.storage.open", mock_open_exp_data, create=False),
         patch("psyserver.main.datetime", mock_datetime),
-        patch("psyserver.settings.get_settings_toml", mock_get_settings),
         patch("psyserver.main.requests.post", mock_request_post),
     ):
         response = client.post("/exp_cute/save", json=example_data)
@@ -357,3 +347,136 @@ def test_save_data_json_h_captcha_failed_response(client):
     mock_open_exp_data.assert_called_once_with(
         Path("data/studydata/exp_cute/debug_1_2023-11-02_01-49-39.json"), "w"
     )
+
+
+def test_save_data_idempotency_key(client):
+    """Retries with the same idempotency key are answered without saving again."""
+    example_data = {"participantID": "debug_1", "condition": "1"}
+    headers = {"Idempotency-Key": "retry-1"}
+    response = client.post("/exp_cute/save", json=example_data, headers=headers)
+    assert response.status_code == 200
+    first_response = response.json()
+
+    mock_open_exp_data = mock_open()
+    with patch("psyserver.storage.open", mock_open_exp_data, create=False):
+        response = client.post("/exp_cute/save", json=example_data, headers=headers)
+        # key can also be given as field
+        response_field = client.post(
+            "/exp_cute/save", json={**example_data, "idempotency_key": "retry-1"}
+        )
+    assert response.json() == first_response
+    assert response_field.json() == first_response
+    mock_open_exp_data.assert_not_called()
+
+    # the same key in another study is independent
+    with patch("psyserver.storage.open", mock_open_exp_data, create=False):
+        client.post("/other_study/save", json=example_data, headers=headers)
+    mock_open_exp_data.assert_called_once()
+
+
+def test_save_data_idempotency_key_after_restart(app):
+    """Responses survive a restart via counter.db."""
+    example_data = {"participantID": "debug_1"}
+    headers = {"Idempotency-Key": "retry-2"}
+    first_response = (
+        TestClient(app).post("/exp_cute/save", json=example_data, headers=headers)
+    ).json()
+
+    mock_open_exp_data = mock_open()
+    with patch("psyserver.storage.open", mock_open_exp_data, create=False):
+        response = TestClient(create_app()).post(
+            "/exp_cute/save", json=example_data, headers=headers
+        )
+    assert response.json() == first_response
+    mock_open_exp_data.assert_not_called()
+
+
+def test_save_audio_idempotency_key(client):
+    files = {"audio_data": ("participant_1.webm", b"fake-audio", "audio/webm")}
+    response = client.post(
+        "/exp_cute/save_audio", files=files, data={"idempotency_key": "audio-1"}
+    )
+    assert response.json()["success"] is True
+
+    mock_open_audio = mock_open()
+    with patch("psyserver.storage.open", mock_open_audio, create=False):
+        retry = client.post(
+            "/exp_cute/save_audio", files=files, headers={"Idempotency-Key": "audio-1"}
+        )
+    assert retry.json() == response.json()
+    mock_open_audio.assert_not_called()
+
+
+def test_save_audio_idempotency_key_concurrent_retry(app, monkeypatch):
+    """A retry arriving during the upload waits for it instead of saving again."""
+    original_read = UploadFile.read
+
+    async def slow_read(self, *args):
+        await asyncio.sleep(0.05)
+        return await original_read(self, *args)
+
+    monkeypatch.setattr(UploadFile, "read", slow_read)
+    writes = []
+    original_write = FileStorage.write
+
+    def counting_write(self, base_path, key, data):
+        writes.append(key)
+        return original_write(self, base_path, key, data)
+
+    monkeypatch.setattr(FileStorage, "write", counting_write)
+    files = {"audio_data": ("participant_1.webm", b"fake-audio", "audio/webm")}
+
+    async def post_twice():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await asyncio.gather(
+                *(
+                    client.post(
+                        "/exp_cute/save_audio",
+                        files=files,
+                        headers={"Idempotency-Key": "audio-1"},
+                    )
+                    for _ in range(2)
+                )
+            )
+
+    first, retry = asyncio.run(post_twice())
+    assert first.json()["success"] is True
+    assert retry.json() == first.json()
+    assert len(writes) == 1
+
+
+def test_idempotency_ttl_reloads(client, configure):
+    """A changed idempotency_ttl applies without recreating the app."""
+    response = client.post(
+        "/exp_cute/save", json={"participantID": "debug_1", "idempotency_key": "k"}
+    )
+    assert response.json()["success"] is True
+
+    configure("idempotency_ttl = -1")
+    mock_open_exp_data = mock_open()
+    with patch("psyserver.storage.open", mock_open_exp_data, create=False):
+        client.post(
+            "/exp_cute/save",
+            json={"participantID": "debug_1", "idempotency_key": "k"},
+        )
+    mock_open_exp_data.assert_called_once()
+
+
+def test_idempotency_db_locked(client, monkeypatch):
+    """A failure to record the key still answers and deduplicates the save."""
+
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(idempotency, "set_idempotent_response_db", locked)
+    data = {"participantID": "debug_1", "idempotency_key": "k"}
+    response = client.post("/exp_cute/save", json=data)
+    assert response.status_code == 200
+    assert response.json()["success"] is True
+
+    retry = client.post("/exp_cute/save", json=data)
+    assert retry.json() == response.json()
+    assert len(list(Path("data/studydata/exp_cute").glob("*.json"))) == 1
@@ -0,0 +1,136 @@
+import hashlib
+import io
+import struct
+import threading
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from psyserver.db import SQLite
+from psyserver.media import (
+    MediaPipeline,
+    create_media_jobs_table,
+    get_media_jobs,
+    process_media,
+)
+
+
+def _wav_bytes(samples, framerate: int = 8000) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f_wav:
+        f_wav.setnchannels(1)
+        f_wav.setsampwidth(2)
+        f_wav.setframerate(framerate)
+        f_wav.writeframes(struct.pack(f"<{len(samples)}h", *samples))
+    return buffer.getvalue()
+
+
+def _speech_with_silence() -> bytes:
+    # 0.1 s silence, 0.2 s loud, 0.1 s silence at 8 kHz
+    loud = [8000 if i % 2 else -8000 for i in range(1600)]
+    return _wav_bytes([0] * 800 + loud + [0] * 800)
+
+
+def test_process_media_steps():
+    path = Path("recording.wav")
+    path.write_bytes(_speech_with_silence())
+
+    result = process_media(
+        str(path),
+        ["checksum", "info", "trim_silence", "resample"],
+        {"sample_rate": 16000, "silence_threshold": 500},
+    )
+
+    assert result["sha256"] == hashlib.sha256(path.read_bytes()).hexdigest()
+    assert result["duration"] == 0.4
+    assert result["sample_rate"] == 8000
+    assert result["trimmed_duration"] == 0.2
+    assert result["processed_path"] == str(Path("processed/recording.wav"))
+    with wave.open(result["processed_path"], "rb") as f_wav:
+        assert f_wav.getframerate() == 16000
+        assert abs(f_wav.getnframes() - 3200) <= 2
+    # the upload itself is left untouched
+    assert path.read_bytes() == _speech_with_silence()
+
+
+def test_pipeline_records_results_and_failures():
+    Path("a.wav").write_bytes(_speech_with_silence())
+    Path("b.webm").write_bytes(b"not a wav")
+    options = {"sample_rate": 16000, "silence_threshold": 500}
+    pipeline = MediaPipeline("media_jobs.db", workers=1)
+    pipeline.enqueue("exp_cute", Path("a.wav"), ["checksum", "info"], options)
+    pipeline.enqueue("exp_cute", Path("b.webm"), ["info"], options)
+    pipeline.wait()
+    pipeline.stop()
+
+    jobs = get_media_jobs("media_jobs.db", "exp_cute")
+    assert [job["status"] for job in jobs] == ["done", "failed"]
+    assert jobs[0]["result"]["duration"] == 0.4
+    assert ".wav" in jobs[1]["error"]
+    assert get_media_jobs("media_jobs.db", "other") == []
+
+
+def test_pipeline_concurrent_enqueue_starts_one_pool(monkeypatch):
+    Path("a.wav").write_bytes(_speech_with_silence())
+    pools = []
+
+    class CountingPool(ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr("psyserver.media.ProcessPoolExecutor", CountingPool)
+    pipeline = MediaPipeline("media_jobs.db", workers=1)
+    threads = [
+        threading.Thread(
+            target=pipeline.enqueue,
+            args=("exp_cute", Path("a.wav"), ["checksum"], {}),
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pipeline.wait()
+    pipeline.stop()
+
+    assert len(pools) == 1
+    jobs = get_media_jobs("media_jobs.db", "exp_cute")
+    assert [job["status"] for job in jobs] == ["done"] * 8
+
+
+def test_pipeline_resumes_unfinished_jobs():
+    Path("a.wav").write_bytes(_speech_with_silence())
+    # a job left running by a stopped server
+    create_media_jobs_table(Path("media_jobs.db"))
+    with SQLite(Path("media_jobs.db")) as conn:
+        conn.execute(
+            "INSERT INTO media_jobs (study, path, steps, options, status)"
+            " VALUES (?, ?, ?, ?, 'running')",
+            ("exp_cute", "a.wav", '["info"]', '{"sample_rate": 16000}'),
+        )
+        conn.commit()
+
+    pipeline = MediaPipeline("media_jobs.db", workers=1)
+    pipeline.resume()
+    pipeline.wait()
+    pipeline.stop()
+
+    jobs = get_media_jobs("media_jobs.db", "exp_cute")
+    assert jobs[0]["status"] == "done"
+    assert jobs[0]["result"]["sample_rate"] == 8000
+
+
+def test_save_audio_enqueues_media_steps(configure):
+    with configure('media_steps = ["info"]') as client:
+        response = client.post(
+            "/exp_cute/save_audio",
+            files={"audio_data": ("rec.wav", _speech_with_silence(), "audio/wav")},
+        )
+        assert response.json()["success"]
+
+    jobs = get_media_jobs("media_jobs.db", "exp_cute")
+    assert len(jobs) == 1
+    assert jobs[0]["path"].endswith(response.json()["filename"])
+    assert jobs[0]["steps"] == ["info"]
@@ -0,0 +1,58 @@
+from fastapi.testclient import TestClient
+
+from psyserver.admin import create_admin_app
+from psyserver.metrics import Counter, Histogram, MetricFamily, Registry
+
+
+def test_histogram_samples():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert histogram.samples("latency", '{route="a"}') == [
+        'latency_bucket{route="a",le="0.1"} 1',
+        'latency_bucket{route="a",le="1.0"} 2',
+        'latency_bucket{route="a",le="+Inf"} 3',
+        'latency_sum{route="a"} 5.55',
+        'latency_count{route="a"} 3',
+    ]
+
+
+def test_registry_render():
+    registry = Registry()
+    family = registry.register(
+        MetricFamily("test_total", "A test counter.", Counter, ("study",))
+    )
+    family.labels('exp_"cute"').inc(2)
+    assert registry.render() == (
+        "# HELP test_total A test counter.\n"
+        "# TYPE test_total counter\n"
+        'test_total{study="exp_\\"cute\\""} 2.0\n'
+    )
+
+
+def test_metrics_endpoint(client):
+    client.get("/exp_cute/get_count")
+    client.post("/exp_cute/save", json={"participantID": "debug_1"})
+
+    response = TestClient(create_admin_app()).get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert any(
+        line.startswith(
+            'psyserver_request_duration_seconds_count{route="/{study}/save",'
+            'study="exp_cute"}'
+        )
+        for line in lines
+    )
+    assert any(
+        line.startswith('psyserver_bytes_written_total{study="exp_cute",kind="json"}')
+        for line in lines
+    )
+    assert any(
+        line.startswith(
+            'psyserver_counter_db_duration_seconds_count{operation="get_increment"}'
+        )
+        for line in lines
+    )
@@ -0,0 +1,187 @@
+import json
+import os
+import random
+import time
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from psyserver.schema import SchemaCache, SchemaError, SchemaViolation, compile_schema
+
+TRIAL_SCHEMA = {
+    "type": "object",
+    "required": ["participantID", "trialdata"],
+    "properties": {
+        "participantID": {"type": "string", "pattern": "^[a-z]+_[0-9]+$"},
+        "trialdata": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["trial", "response"],
+                "additionalProperties": False,
+                "properties": {
+                    "trial": {"type": "integer", "minimum": 1},
+                    "condition": {"enum": ["a", "b"]},
+                    "response": {"type": ["number", "null"]},
+                    "rt": {"type": "number", "exclusiveMinimum": 0},
+                },
+            },
+        },
+    },
+}
+
+
+def _write_schema(schema) -> None:
+    with open("data/studies/exp_cute/schema.json", "w") as f_schema:
+        json.dump(schema, f_schema)
+
+
+def test_compile_schema():
+    validate = compile_schema(TRIAL_SCHEMA)
+    valid = {
+        "participantID": "debug_1",
+        "trialdata": [{"trial": 1, "condition": "a", "response": None, "rt": 0.5}],
+        "other": "data",
+    }
+    validate(valid)
+
+    invalid = [
+        ({**valid, "participantID": "Debug 1"}, "['participantID']: does not match"),
+        ({**valid, "trialdata": []}, "['trialdata']: expected at least 1 items."),
+        ({"participantID": "debug_1"}, "data: missing required entry 'trialdata'."),
+        (
+            {**valid, "trialdata": [{"trial": 1, "response": 2}, {"trial": True}]},
+            "['trialdata'][1]: missing required entry 'response'.",
+        ),
+        (
+            {**valid, "trialdata": [{"trial": True, "response": 2}]},
+            "['trialdata'][0]['trial']: expected integer.",
+        ),
+        (
+            {**valid, "trialdata": [{"trial": 1, "response": 2, "x": 1}]},
+            "['trialdata'][0]: entry 'x' not allowed.",
+        ),
+        (
+            {**valid, "trialdata": [{"trial": 1, "response": "2"}]},
+            "['trialdata'][0]['response']: expected number or null.",
+        ),
+        (
+            {**valid, "trialdata": [{"trial": 1, "response": 2, "condition": "c"}]},
+            "['trialdata'][0]['condition']: expected one of ['a', 'b'].",
+        ),
+    ]
+    for data, message in invalid:
+        with pytest.raises(SchemaViolation) as violation:
+            validate(data)
+        assert str(violation.value).startswith(message)
+
+    # booleans are not numbers
+    for schema, value in [
+        ({"enum": [1, 2]}, True),
+        ({"const": 0}, False),
+        ({"enum": [[1]]}, [True]),
+        ({"const": True}, 1),
+    ]:
+        with pytest.raises(SchemaViolation):
+            compile_schema(schema)(value)
+    compile_schema({"enum": [1, True]})(True)
+    compile_schema({"const": {"a": [1.0]}})({"a": [1]})
+
+    with pytest.raises(SchemaError):
+        compile_schema({"type": "object", "oneOf": []})
+
+
+def test_schema_cache_recompiles_changed_file():
+    _write_schema({"required": ["participantID"]})
+    cache = SchemaCache(poll_interval=0)
+    studies_dir = Path("data/studies")
+    validate = cache.get(studies_dir, "exp_cute")
+    assert cache.get(studies_dir, "exp_cute") is validate
+    assert cache.get(studies_dir, "exp_uncute") is None
+
+    _write_schema({"required": ["participantID", "condition"]})
+    # same size and mtime resolution may hide the change
+    os.utime("data/studies/exp_cute/schema.json", ns=(0, 0))
+    validate = cache.get(studies_dir, "exp_cute")
+    with pytest.raises(SchemaViolation):
+        validate({"participantID": "debug_1"})
+
+    # invalid schemas keep the previous one
+    with open("data/studies/exp_cute/schema.json", "w") as f_schema:
+        f_schema.write("{")
+    assert cache.get(studies_dir, "exp_cute") is validate
+
+
+def test_schema_cache_is_bounded():
+    cache = SchemaCache(max_entries=10)
+    for i in range(50):
+        assert cache.get(Path("data/studies"), f"junk_{i}") is None
+    assert len(cache._entries) == 10
+
+
+def test_save_data_schema_modes(client: TestClient, configure):
+    _write_schema(TRIAL_SCHEMA)
+    invalid = {"participantID": "debug_1", "trialdata": [{"trial": 0}]}
+
+    response = client.post("/exp_cute/save", json=invalid)
+    assert response.status_code == 422
+    assert "['trialdata'][0]" in response.json()["detail"]
+    assert not list(Path("data/studydata/exp_cute").glob("*.json"))
+
+    client = configure('schema_mode = "flag"')
+
+    response = client.post("/exp_cute/save", json=invalid)
+    assert response.json()["success"]
+    assert "schema: ['trialdata'][0]" in response.json()["status"]
+    (saved,) = Path("data/studydata/exp_cute").glob("*.json")
+    with open(saved) as f_saved:
+        assert "schema_violation" in json.load(f_saved)
+
+
+def test_validation_overhead_10mb():
+    rng = random.Random(0)
+    data = {
+        "participantID": "debug_1",
+        "trialdata": [
+            {
+                "trial": trial,
+                "condition": rng.choice("ab"),
+                "response": rng.random(),
+                "rt": rng.random() + 0.1,
+            }
+            for trial in range(1, 130_000)
+        ],
+    }
+    payload = json.dumps(data)
+    assert len(payload) > 10_000_000
+    validate = compile_schema(TRIAL_SCHEMA)
+
+    def best_of(function, repeat=3):
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+        return min(durations)
+
+    validate_time = best_of(lambda: validate(data))
+    # validation has to be cheaper than the parsing the request needs anyway
+    parse_time = best_of(lambda: json.loads(payload))
+    assert validate_time < 2 * parse_time, (validate_time, parse_time)
+
+
+def test_save_data_schema_required_null(client: TestClient):
+    _write_schema(
+        {
+            "required": ["response"],
+            "properties": {"response": {"type": ["number", "null"]}},
+        }
+    )
+
+    response = client.post("/exp_cute/save", json={"response": None})
+    assert response.status_code == 200
+
+    response = client.post("/exp_cute/save", json={})
+    assert response.status_code == 422
@@ -0,0 +1,92 @@
+import pytest
+from pydantic import ValidationError
+
+from psyserver.settings import (
+    get_settings_toml,
+    get_study_settings,
+    load_settings_snapshot,
+    reset_settings,
+    settings_store,
+)
+
+
+def _write_config(config: str) -> None:
+    with open("psyserver.toml", "w") as f_config:
+        f_config.write(config)
+
+
+@pytest.fixture()
+def poll_always(monkeypatch):
+    monkeypatch.setattr(settings_store, "poll_interval", 0)
+
+
+def test_settings_immutable():
+    with pytest.raises(ValidationError):
+        get_settings_toml().h_captcha_secret = "secret"
+
+
+def test_settings_hot_reload(poll_always):
+    assert get_settings_toml().redirect_url is None
+
+    _write_config('[psyserver]\nredirect_url = "https://example.com"\n')
+    assert get_settings_toml().redirect_url == "https://example.com"
+
+
+def test_settings_invalid_reload_keeps_old(poll_always):
+    _write_config('[psyserver]\nredirect_url = "https://example.com"\n')
+    old = get_settings_toml()
+
+    _write_config("[psyserver]\nrate_limit_client = 'many'\n")
+    assert get_settings_toml() is old
+    _write_config("[psyserver\n")
+    assert get_settings_toml() is old
+
+
+def test_study_overrides():
+    _write_config(
+        "[psyserver]\n"
+        "rate_limit_study = 10\n"
+        'redirect_url = "https://example.com"\n'
+        "[psyserver.studies.exp_cute]\n"
+        "rate_limit_study = 1\n"
+    )
+    reset_settings()
+    assert get_study_settings("exp_cute").rate_limit_study == 1
+    assert get_study_settings("exp_cute").redirect_url == "https://example.com"
+    assert get_study_settings("other_study").rate_limit_study == 10
+    # resolved once, not per lookup
+    assert get_study_settings("exp_cute") is get_study_settings("exp_cute")
+
+
+def test_study_overrides_invalid():
+    _write_config("[psyserver]\n[psyserver.studies.exp_cute]\nunknown_key = 1\n")
+    reset_settings()
+    with pytest.raises(ValidationError):
+        get_settings_toml()
+
+
+def test_limits_validated(poll_always):
+    old = get_settings_toml()
+    for config in (
+        "rate_limit_client = 0",
+        "rate_limit_study = -1",
+        "rate_limit_client_burst = 0.5",
+        "max_concurrent_writes = 0",
+        "max_write_queue = -1",
+        "write_queue_timeout = 0",
+    ):
+        _write_config(f"[psyserver]\n{config}\n")
+        with pytest.raises(ValidationError):
+            load_settings_snapshot()
+        assert get_settings_toml() is old, config
+
+
+def test_study_overrides_server_wide():
+    for config in (
+        'storage = "sqlite"',
+        "max_concurrent_writes = 1",
+        "s3_prefix = 'a'",
+    ):
+        _write_config(f"[psyserver]\n[psyserver.studies.exp_cute]\n{config}\n")
+        with pytest.raises(ValueError, match="server-wide"):
+            load_settings_snapshot()
@@ -0,0 +1,195 @@
+import asyncio
+import re
+from pathlib import Path
+
+import httpx
+import pytest
+from pydantic import ValidationError
+
+from psyserver.settings import Settings
+from psyserver.storage import (
+    FileStorage,
+    S3Storage,
+    SQLiteStorage,
+    StorageBackend,
+)
+
+
+class FakeS3:
+    """Minimal in-memory S3 server for PUT object and multipart uploads."""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.n_requests = 0
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.n_requests += 1
+        assert request.headers["Authorization"].startswith("AWS4-HMAC-SHA256")
+        key = request.url.path
+        params = request.url.params
+        if request.method == "POST" and "uploads" in params:
+            upload_id = f"upload-{len(self.uploads)}"
+            self.uploads[upload_id] = {}
+            body = f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>"
+            return httpx.Response(200, text=body + "</InitiateMultipartUploadResult>")
+        if request.method == "PUT" and "partNumber" in params:
+            number = int(params["partNumber"])
+            self.uploads[params["uploadId"]][number] = request.content
+            return httpx.Response(200, headers={"ETag": f'"etag-{number}"'})
+        if request.method == "POST" and "uploadId" in params:
+            parts = self.uploads.pop(params["uploadId"])
+            numbers = [
+                int(n)
+                for n in re.findall(r"<PartNumber>(\d+)", request.content.decode())
+            ]
+            self.objects[key] = b"".join(parts[number] for number in numbers)
+            return httpx.Response(200, text="<CompleteMultipartUploadResult/>")
+        if request.method == "PUT":
+            self.objects[key] = request.content
+            return httpx.Response(200)
+        return httpx.Response(400)
+
+
+def _s3_storage(fake: FakeS3, **kwargs) -> S3Storage:
+    return S3Storage(
+        endpoint_url="http://s3.test",
+        bucket="studydata",
+        access_key="access",
+        secret_key="secret",
+        transport=httpx.MockTransport(fake.handle),
+        **kwargs,
+    )
+
+
+def test_s3_storage_uploads_from_spool():
+    fake = FakeS3()
+
+    async def run():
+        storage = _s3_storage(fake, part_size=4)
+        storage.write(Path("unused"), "exp_cute/small.json", '{"a":1}'[:4])
+        storage.write(Path("unused"), "exp_cute/audio/large.wav", b"0123456789")
+        # data is spooled locally before it is uploaded
+        assert (Path("spool") / "exp_cute/audio/large.wav").exists()
+        await storage.drain()
+        await storage.stop()
+
+    asyncio.run(run())
+    assert fake.objects == {
+        "/studydata/exp_cute/small.json": b'{"a"',
+        "/studydata/exp_cute/audio/large.wav": b"0123456789",
+    }
+    assert not list(Path("spool").rglob("*.*"))
+
+
+def test_s3_storage_resumes_spool_after_restart():
+    spooled = Path("spool/exp_cute/debug_1.json")
+    spooled.parent.mkdir(parents=True)
+    spooled.write_text('{"participantID": "debug_1"}')
+    fake = FakeS3()
+
+    async def run():
+        storage = _s3_storage(fake)
+        assert storage.pending() == ["exp_cute/debug_1.json"]
+        await storage.start()
+        await storage.drain()
+        await storage.stop()
+
+    asyncio.run(run())
+    assert fake.objects == {
+        "/studydata/exp_cute/debug_1.json": b'{"participantID": "debug_1"}'
+    }
+    assert not spooled.exists()
+
+
+def test_s3_storage_retries_failed_upload():
+    fake = FakeS3()
+    responses = iter([httpx.Response(503)])
+
+    def flaky(request):
+        return next(responses, None) or fake.handle(request)
+
+    async def run():
+        storage = _s3_storage(fake, retry_delay=0.01)
+        storage.transport = httpx.MockTransport(flaky)
+        storage.write(Path("unused"), "exp_cute/debug_1.json", "{}")
+        await storage.drain()
+        assert Path("spool/exp_cute/debug_1.json").exists()
+        await asyncio.sleep(0.05)
+        await storage.drain()
+        await storage.stop()
+
+    asyncio.run(run())
+    assert fake.objects == {"/studydata/exp_cute/debug_1.json": b"{}"}
+
+
+def test_sqlite_storage():
+    storage = SQLiteStorage("studydata.db")
+    assert storage.write(Path("unused"), "exp_cute/debug_1.json", "{}") is None
+    assert storage.write(Path("unused"), "exp_cute/debug_1.json", '{"a": 1}') == 2
+    storage.write(Path("unused"), "exp_cute/audio/a.webm", b"audio")
+    storage.write(Path("unused"), "other/debug_1.json", "{}")
+    assert storage.read(Path("unused"), "exp_cute/debug_1.json") == b'{"a": 1}'
+    assert storage.keys("exp_cute/") == [
+        "exp_cute/audio/a.webm",
+        "exp_cute/debug_1.json",
+    ]
+
+
+def test_save_data_sqlite_storage(configure):
+    client = configure('storage = "sqlite"')
+
+    response = client.post("/exp_cute/save", json={"participantID": "debug_1"})
+    assert response.json()["success"]
+
+    storage = SQLiteStorage("studydata.db")
+    keys = storage.keys("exp_cute/")
+    assert len(keys) == 1
+    assert keys[0].startswith("exp_cute/debug_1_")
+    assert not list(Path("data/studydata/exp_cute").glob("*.json"))
+
+    # nothing is created in data_dir
+    response = client.post(
+        "/exp_new/save", json={"participantID": "debug_1", "session_dir": "s1"}
+    )
+    assert response.json()["success"]
+    assert not Path("data/studydata/exp_new").exists()
+
+
+def test_storage_backend_is_abstract():
+    with pytest.raises(TypeError):
+        StorageBackend()
+
+
+@pytest.mark.parametrize("max_connections", [1, 4])
+def test_s3_storage_rewrite_during_upload(max_connections):
+    fake = FakeS3()
+
+    async def run():
+        storage = _s3_storage(fake, max_connections=max_connections)
+
+        async def rewrite_during_first_put(request):
+            if not fake.n_requests:
+                storage.write(Path("unused"), "exp_cute/debug_1.json", "new")
+                await asyncio.sleep(0.01)
+            return fake.handle(request)
+
+        storage.transport = httpx.MockTransport(rewrite_during_first_put)
+        storage.write(Path("unused"), "exp_cute/debug_1.json", "old")
+        await storage.drain()
+        await storage.stop()
+
+    asyncio.run(run())
+    assert fake.objects == {"/studydata/exp_cute/debug_1.json": b"new"}
+    assert not Path("spool/exp_cute/debug_1.json").exists()
+
+
+def test_s3_part_size_validated():
+    with pytest.raises(ValidationError):
+        Settings(s3_part_size=1024)
+
+
+def test_file_storage_write_returns_replaced_size():
+    storage = FileStorage()
+    assert storage.write(Path("data"), "exp_cute/debug_1.json", "{}") is None
+    assert storage.write(Path("data"), "exp_cute/debug_1.json", '{"a": 1}') == 2
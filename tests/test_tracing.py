@@ -0,0 +1,87 @@
+import json
+import time
+from pathlib import Path
+
+from psyserver.tracing import (
+    SamplingProfiler,
+    Trace,
+    _current_trace,
+    mark_since_start,
+    span,
+)
+
+
+def _server_timing(response) -> dict:
+    timings = {}
+    for entry in response.headers["server-timing"].split(", "):
+        name, duration = entry.split(";dur=")
+        timings[name] = float(duration)
+    return timings
+
+
+def test_server_timing_save(client):
+    response = client.post("/exp_cute/save", json={"participantID": "debug_1"})
+    timings = _server_timing(response)
+    assert {"parse", "path", "serialize", "write", "total"} <= set(timings)
+    assert timings["total"] >= timings["write"]
+
+
+def test_parse_excludes_queue_wait():
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        with span("queue"):
+            time.sleep(0.05)
+        mark_since_start("parse")
+    finally:
+        _current_trace.reset(token)
+    assert trace.spans["queue"] >= 0.05
+    assert trace.spans["parse"] < 0.01
+
+
+def test_server_timing_queue(configure):
+    client = configure("max_concurrent_writes = 1")
+    response = client.post("/exp_cute/save", json={"participantID": "debug_1"})
+    assert "queue" in _server_timing(response)
+
+
+def test_server_timing_counter(client):
+    response = client.get("/exp_cute/get_count")
+    assert "counter_db" in _server_timing(response)
+
+
+def test_trace_log(configure):
+    client = configure('trace_log = "trace.jsonl"')
+    client.post("/exp_cute/save", json={"participantID": "debug_1"})
+    client.get("/exp_cute/get_count")
+
+    with open("trace.jsonl", "r") as f_trace:
+        records = [json.loads(line) for line in f_trace]
+    assert [record["path"] for record in records] == [
+        "/exp_cute/save",
+        "/exp_cute/get_count",
+    ]
+    assert records[0]["status"] == 200
+    assert "write" in records[0]["spans_ms"]
+    assert records[1]["total_ms"] >= records[1]["spans_ms"]["counter_db"]
+
+
+def test_sampling_profiler_keeps_slowest():
+    profile_dir = Path("profiles")
+    profiler = SamplingProfiler(n_slowest=2, profile_dir=profile_dir, interval=0.001)
+    try:
+        for duration in (0.02, 0.04, 0.03, 0.01):
+            start = time.perf_counter()
+            time.sleep(duration)
+            profiler.finish_request("GET /exp_cute/", start, time.perf_counter())
+    finally:
+        profiler.stop()
+
+    profiles = sorted(profile_dir.iterdir())
+    assert len(profiles) == 2
+    durations = sorted(int(path.stem.split("_")[-1][:-2]) for path in profiles)
+    assert durations[0] >= 29
+    # collapsed stacks: "frame;frame;... count"
+    lines = profiles[0].read_text().splitlines()
+    assert lines
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
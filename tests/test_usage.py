@@ -0,0 +1,86 @@
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+from psyserver.admin import create_admin_app
+from psyserver.settings import Settings
+from psyserver.storage import SQLiteStorage
+from psyserver.usage import USAGE, DiskUsage, seed_usage
+
+
+def test_seed_counts_studies_and_sessions():
+    data_dir = Path("scanned")
+    (data_dir / "exp_cute/screening/audio").mkdir(parents=True)
+    (data_dir / "exp_cute/audio").mkdir(parents=True)
+    (data_dir / "exp_cute/debug_1.json").write_text("12345")
+    (data_dir / "exp_cute/audio/a.wav").write_bytes(b"123")
+    (data_dir / "exp_cute/screening/debug_2.json").write_text("12")
+    (data_dir / "exp_cute/screening/audio/b.wav").write_bytes(b"1")
+
+    usage = DiskUsage()
+    usage.add("exp_cute", "screening/part_1", 10)
+    usage.seed(data_dir, workers=2)
+    usage.add("exp_cute", None, 4)
+    # replacing a file only counts the difference
+    usage.add("exp_cute", None, 6, replaced=4)
+
+    report = usage.report()["exp_cute"]
+    assert report["bytes"] == 5 + 3 + 2 + 1 + 6
+    assert report["files"] == 5
+    assert report["sessions"] == {
+        "": {"bytes": 14, "files": 3},
+        "screening": {"bytes": 3, "files": 2},
+    }
+
+
+def test_quotas(configure):
+    client = configure("quota_soft_bytes = 100\nquota_hard_bytes = 200")
+    USAGE.seed("data/studydata")
+
+    response = client.post("/exp_cute/save", json={"participantID": "debug_1"})
+    assert "quota" not in response.json().get("status", "")
+    response = client.post("/exp_cute/save", json={"participantID": "debug_2"})
+    assert response.json()["success"]
+    assert "soft limit exceeded" in response.json()["status"]
+
+    response = client.post("/exp_cute/save", json={"participantID": "debug_3"})
+    assert response.status_code == 507
+    assert len(list(Path("data/studydata/exp_cute").glob("*.json"))) == 2
+
+    # other studies are not affected
+    response = client.post("/exp_uncute/save", json={"participantID": "debug_1"})
+    assert response.status_code == 200
+
+    admin = TestClient(create_admin_app())
+    usage = admin.get("/usage").json()
+    # the saves and the .gitkeep of the example
+    assert usage["exp_cute"]["files"] == 3
+    assert usage["exp_cute"]["bytes"] == sum(
+        path.stat().st_size for path in Path("data/studydata/exp_cute").glob("*")
+    )
+
+
+def test_seed_from_sqlite_storage():
+    storage = SQLiteStorage("studydata.db")
+    storage.write(Path("unused"), "exp_cute/debug_1.json", "12345")
+    storage.write(Path("unused"), "exp_cute/audio/a.wav", b"123")
+    storage.write(Path("unused"), "exp_cute/screening/audio/b.wav", b"1")
+
+    usage = DiskUsage()
+    seed_usage(usage, storage, "data/studydata")
+
+    assert usage.report()["exp_cute"] == {
+        "bytes": 9,
+        "files": 3,
+        "sessions": {
+            "": {"bytes": 8, "files": 2},
+            "screening": {"bytes": 1, "files": 1},
+        },
+    }
+
+
+def test_quotas_refused_with_s3():
+    with pytest.raises(ValidationError):
+        Settings(storage="s3", quota_hard_bytes=100)